@@ -3,6 +3,8 @@ import memory; mem = memory.Memory
 import database; db = database.Database
 import core.io; io = core.io.IO
 from metafinder import Metafinder
+from snapshot import Snapshot
+from battlemath import BattleMath
 import movement
 import interact
 import battle
@@ -26,12 +28,33 @@ class Bot():
         self.saved_keys = 0
         self.tgt_script = None # Next script manually handled by the user
         self.tgt_choices = []
+        # Only the current bot is saved with snapshots
+        if (old := getattr(Bot, "instance", None)) is not None:
+            Snapshot.unregister(old)
         Bot.instance = self
 
         # NPC interactions
-        self.npc_hooks = {}
         self.npc_waitlist = set()
         self.npc_visited = set()
+        Snapshot.register(self)
+
+    def getState(self):
+        """ Interaction tracking and battle state, saved with snapshots """
+        return (self.npc_waitlist.copy(), self.npc_visited.copy(),
+                self.tgt_script, self.tgt_choices.copy(),
+                self.was_in_battle, self.saved_keys)
+    def setState(self, state):
+        (waitlist, visited, self.tgt_script, choices,
+         self.was_in_battle, self.saved_keys) = state
+        self.npc_waitlist = waitlist.copy()
+        self.npc_visited = visited.copy()
+        self.tgt_choices = choices.copy()
+        # Running scripts cannot be rewound, restart them from the restored game
+        if self.was_in_battle:
+            self.battle_script = self.battle_fun(self)
+        # An interaction in progress is handled again as a new one
+        self.was_interacting = False
+        self.interact_script = None
 
     def getWeakenMove():
         """
@@ -40,20 +63,13 @@ class Bot():
         """
         p = db.battlers[0]
         e = db.battlers[1]
-        best = None
-        maxdmg = 0
-
-        for i, move in enumerate(p.moves):
-            if p.pps[i] == 0:
-                continue
-            dmg = p.potentialDamage(e, move)
-            if dmg[1] == 0:
-                continue
-            # TODO: consider moves with low chance to kill
-            if np.ceil(dmg[1]) < e.curr_hp and (best is None or dmg[1] > maxdmg):
-                best = i
-                maxdmg = dmg[1]
-        return best
+        dmg = BattleMath.damage(p, [e])[:,0,-1]
+        usable = np.array(p.pps[:len(dmg)]) > 0
+        # TODO: consider moves with low chance to kill
+        candidates = usable & (dmg > 0) & (np.ceil(dmg) < e.curr_hp)
+        if not candidates.any():
+            return None
+        return int(np.argmax(np.where(candidates, dmg, -1)))
 
     def getBestMove():
         """
@@ -64,18 +80,14 @@ class Bot():
         """
         p = db.battlers[0]
         e = db.battlers[1]
-        best = 0
-        mindmg = 0
-
-        for i, move in enumerate(p.moves):
-            if p.pps[i] == 0:
-                continue
-            dmg = p.potentialDamage(e, move)
-            if ((mindmg < e.curr_hp and dmg[0] > mindmg) or
-                (dmg[0] > e.curr_hp and dmg[0] < mindmg)):
-                best = i
-                mindmg = dmg[0]
-        return best
+        dmg = BattleMath.damage(p, [e])[:,0,0]
+        usable = np.array(p.pps[:len(dmg)]) > 0
+        if not usable.any():
+            return 0
+        lethal = usable & (dmg >= e.curr_hp)
+        if lethal.any():
+            return int(np.argmin(np.where(lethal, dmg, np.inf)))
+        return int(np.argmax(np.where(usable, dmg, -1)))
 
     def doInteraction(choices=[]):
         """
@@ -143,17 +155,27 @@ class Bot():
 
     def getBestMon():
         """
-        TODO: consider type advantage
+        Returns the party index of the pokemon to send against the current enemy
+        Scored by its best offensive type multiplier over the enemy's best one against it,
+        weighted by its remaining hp
         """
-        best_id = 0
-        for i, pkmn in enumerate(db.pteam):
-            if pkmn.growth.species_idx == 0:
-                break
-            if pkmn.curr_hp == 0:
-                continue
-            if pkmn.curr_hp > db.pteam[best_id].curr_hp:
-                best_id = i
-        return best_id
+        party = db.pteam[:db.getPartySize()]
+        if len(party) == 0:
+            return 0
+        e = db.battlers[1]
+        species = np.array([BattleMath.getSpeciesId(p) for p in party])
+        moves = BattleMath.getTeamMoves(party)
+        power = BattleMath.getMoveTable()["power"]
+        e_species = BattleMath.getSpeciesId(e)
+        e_moves = BattleMath.getTeamMoves([e])[0]
+        # (party, 4) multipliers of our moves, (party, 4) multipliers of the enemy's moves
+        offense = db.getEffectiveness(moves, e_species) * db.getStab(moves, species[:,None])
+        offense = np.max(np.where(power[moves] > 0, offense, 0), axis=1)
+        defense = db.getEffectiveness(e_moves[None,:], species[:,None]) * db.getStab(e_moves, e_species)
+        defense = np.max(np.where(power[e_moves] > 0, defense, 0), axis=1)
+        hp = np.array([p.curr_hp / max(p.max_hp, 1) for p in party])
+        score = (offense + 0.25) / (defense + 0.25) * hp
+        return int(np.argmax(np.where(hp > 0, score, -1)))
 
     def track(self, pscript):
         """
@@ -164,10 +186,6 @@ class Bot():
         if pscript is None or pscript.key in self.npc_visited:
             return
         self.npc_visited.add(pscript.key)
-        for var in pscript.inputs.getTrackable():
-            if var not in self.npc_hooks:
-                self.npc_hooks[var] = []
-            self.npc_hooks[var].append(pscript.key)
         self.checkTracked([pscript.key])
 
     def checkTracked(self, keys):
@@ -191,9 +209,10 @@ class Bot():
         """
         if len(changed):
             print(", ".join([str(x) for x in changed]))
-        for var in changed:
-            if var in self.npc_hooks:
-                self.checkTracked(self.npc_hooks[var])
+        Metafinder.invalidate(changed)
+        for var in Script.StorageSet(changed).getTrackable():
+            # Only scripts of NPCs already met are tracked
+            self.checkTracked(Script.getReaders(var) & self.npc_visited)
 
 
     def exploreMap(self):
@@ -330,8 +349,8 @@ class Bot():
                     vars_new = db.getScriptVars()
                     flags_changed = np.where(flags_new != flags_old)[0]
                     vars_changed = np.where(vars_new != vars_old)[0]
-                    changed = [Script.Flag(x) for x in flags_changed]
-                    changed += [Script.Var(0x4000+x) for x in vars_changed]
+                    changed = [Script.Flag(int(x)) for x in flags_changed]
+                    changed += [Script.Var(0x4000+int(x)) for x in vars_changed]
                     if pscript:
                         self.npc_waitlist.discard(pscript.key)
                     self.checkHooks(changed)
@@ -0,0 +1,108 @@
+import multiprocessing
+import mgba
+import memory; mem = memory.Memory
+import database; db = database.Database
+import core.io; io = core.io.IO
+from snapshot import Snapshot
+from bot import Bot
+import battle
+
+class Lookahead:
+    """
+    Battle planner playing out each move choice on copies of the emulator.
+    Simulations run headless in forked worker processes, which are kept
+    between decisions and receive the current state for each of them.
+    """
+    pool = None
+    frame_budget = 3000 # Maximum number of emulated frames to play out a move choice, all turns included
+
+    def init(processes=4):
+        """
+        Fork the worker processes, once the game and database are loaded
+        Must be called before any thread is started, forked workers do not inherit them
+        and could wait forever on a lock held at that time
+        """
+        Lookahead.pool = multiprocessing.get_context("fork").Pool(processes)
+
+    def close():
+        if Lookahead.pool is not None:
+            Lookahead.pool.terminate()
+            Lookahead.pool.join()
+            Lookahead.pool = None
+
+    def _play(gen, frames, max_frames):
+        """ Run a battle generator headless until it ends, the battle ends or the budget is spent """
+        while frames < max_frames and db.isInBattle():
+            try:
+                next(gen)
+            except StopIteration:
+                break
+            Snapshot.core.run_frame()
+            mem.updateBuffers()
+            frames += 1
+        return frames
+
+    def _simulate(task):
+        """ Worker side of simulate, returns the outcome of a move """
+        state, keys, move_id, turns, budget = task
+        Snapshot.load(mgba.ffi.from_buffer(state))
+        io.setRaw(keys)
+        frames = 0
+        for turn in range(turns):
+            bm = db.battle_menu
+            if not db.isInBattle() or not (bm.is_open and bm.menu == 0):
+                break
+            # Following turns use the greedy choice
+            atk_id = move_id if turn == 0 else Bot.getBestMove()
+            frames = Lookahead._play(battle.attack(atk_id), frames, budget)
+            frames = Lookahead._play(battle.waitMainScreen(), frames, budget)
+        p = db.battlers[0]
+        e = db.battlers[1]
+        return {"move": move_id,
+                "player_hp": p.curr_hp / max(p.max_hp, 1),
+                "enemy_hp": e.curr_hp / max(e.max_hp, 1),
+                "in_battle": db.isInBattle(),
+                "frames": frames}
+
+    def simulate(turns=1, budget=None):
+        """
+        Play out every usable move from the move selection screen
+        turns: number of turns to simulate, following ones use Bot.getBestMove
+        budget: maximum number of frames emulated for each move, all turns included
+        Returns the list of outcomes, with hp as fractions of the max hp
+        """
+        if budget is None:
+            budget = Lookahead.frame_budget
+        state = bytes(mgba.ffi.buffer(Snapshot.core.save_raw_state()))
+        keys = io.getRaw()
+        p = db.battlers[0]
+        tasks = [(state, keys, i, turns, budget) for i in range(len(p.moves)) if p.pps[i] > 0]
+        if Lookahead.pool is None:
+            print("lookahead error: worker processes were not started")
+            return []
+        return Lookahead.pool.map(Lookahead._simulate, tasks)
+
+    def getBestMove(turns=1, budget=None):
+        """
+        Returns the index of the move leaving the enemy with the least hp,
+        preferring outcomes where the player's pokemon survives
+        """
+        outcomes = Lookahead.simulate(turns, budget)
+        if len(outcomes) == 0:
+            return Bot.getBestMove()
+        best = max(outcomes, key=lambda o: (o["player_hp"] > 0, -o["enemy_hp"], o["player_hp"]))
+        return best["move"]
+
+    def getWeakenMove(turns=1, budget=None):
+        """
+        Returns the index of the move leaving the enemy with the least hp without fainting it,
+        None if every move knocks it out
+        """
+        outcomes = [o for o in Lookahead.simulate(turns, budget)
+                    if o["enemy_hp"] > 0 and o["in_battle"]]
+        if len(outcomes) == 0:
+            return None
+        best = max(outcomes, key=lambda o: (o["player_hp"] > 0, -o["enemy_hp"], o["player_hp"]))
+        if best["enemy_hp"] >= 1:
+            return None
+        return best["move"]
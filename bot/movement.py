@@ -74,12 +74,15 @@ def step(btn):
     yield from misc.waitWhile(moving)
     return 0
 
-def to(target_func, dist_func, max_dist = 0):
+def to(target_func, dist_func, max_dist = 0, search_func=None, init_path=None):
     """
     Moves to reach a defined target.
     target_func returns the current target, and is monitored for changes
-    dist_func computes the distance to the current target
+    dist_func(x, y, tgt) computes the distance from a tile to the current target,
+    only used by the default A* search
     max_dist is the distance required to successfully reach the target
+    search_func(finder, x, y, tgt) optionally replaces the default A* search
+    init_path optionally gives a precomputed tile path, walked before any search
     """
     def _getOWParams():
         return [[ow.dest_x, ow.dest_y] for ow in db.ows]
@@ -103,14 +106,32 @@ def to(target_func, dist_func, max_dist = 0):
                     break
         return ret
 
+    def _isFree(path):
+        """ Check that no NPC currently stands on a path """
+        tiles = {tuple(tile) for tile in path}
+        for ow in db.ows[1:]:
+            if ow.bank_id != db.player.bank_id or ow.map_id != db.player.map_id:
+                continue
+            if (ow.dest_x, ow.dest_y) in tiles or (ow.x, ow.y) in tiles:
+                return False
+        return True
+
     p = db.player
     m = db.getCurrentMap()
     finder = m.getPathfinder()
     ows = _getOWParams()
+    # Precomputed paths may have been found before NPCs moved in the way
+    if init_path is not None and not _isFree(init_path):
+        init_path = None
 
     while True:
         tgt = target_func()
-        path = finder.search(p.x, p.y, lambda n: dist_func(n, tgt), max_dist)
+        if init_path is not None:
+            path, init_path = list(init_path), None
+        elif search_func is None:
+            path = finder.search(p.x, p.y, lambda x, y: dist_func(x, y, tgt), max_dist)
+        else:
+            path = search_func(finder, p.x, p.y, tgt)
         if path is None:
             print("to error: no path found: (%d,%d) to (%d,%d)" % (p.x, p.y, *tgt))
             return -1
@@ -144,16 +165,31 @@ def to(target_func, dist_func, max_dist = 0):
             return 0
     return 0
 
-def toAny(locs, max_dist=0):
+def _plannerSearch(max_dist):
+    """
+    search_func keeping an incremental planner while the target does not move,
+    so that NPCs crossing the path only repair part of it
+    """
+    planner = None
+    def _search(finder, x, y, tgt):
+        nonlocal planner
+        locs = np.reshape(tgt, (-1, 2))
+        if planner is None or not np.array_equal(planner.locs, locs):
+            planner = finder.getPlanner(locs, max_dist)
+        return planner.search(x, y)
+    return _search
+
+def toAny(locs, max_dist=0, path=None):
     """
     Run pathfinding to a collection of nodes stored as a 2D numpy array
+    Static targets use the map's cached distance fields
+    path: optional tile path already computed to the target
     """
     tgt_func = lambda: locs
-    dist_func = lambda n, tgt: np.linalg.norm(tgt - [n.x, n.y], ord=1, axis=1).min()
-    return (yield from to(tgt_func, dist_func, max_dist))
+    return (yield from to(tgt_func, None, max_dist, _plannerSearch(max_dist), path))
 
-def toPos(x, y, max_dist=0):
-    return (yield from toAny(np.array([[x, y]]), max_dist))
+def toPos(x, y, max_dist=0, path=None):
+    return (yield from toAny(np.array([[x, y]]), max_dist, path))
 
 def toSign(info, max_dist=1):
     """
@@ -165,7 +201,7 @@ def toSign(info, max_dist=1):
     yield from toPos(sign.x, sign.y, max_dist)
     return (yield from turnTowards(sign.x, sign.y))
 
-def toPers(info, max_dist=1):
+def toPers(info, max_dist=1, path=None):
     """
     toPers(info)    Move to a NPC
     info: either PersonEvent or person local index
@@ -185,13 +221,12 @@ def toPers(info, max_dist=1):
     if not pers.isVisible():
         return -1
     tgt_func = lambda: _getTargetPos(pers)
-    dist_func = lambda n, tgt: np.linalg.norm(tgt - [n.x, n.y], ord=1)
-    if (yield from to(tgt_func, dist_func, max_dist)) == -1:
+    if (yield from to(tgt_func, None, max_dist, _plannerSearch(max_dist), path)) == -1:
         return -1
     tx, ty = _getTargetPos(pers)
     return (yield from turnTowards(tx, ty))
 
-def toConnection(info):
+def toConnection(info, path=None):
     """
     toConnection(info)    Leave the current map in the specified direction
     info: either Connection, connection index, or ConnectionType
@@ -206,11 +241,11 @@ def toConnection(info):
         print("connection error: no connection of type %d in map (%d,%d)" %
               (ctype, db.player.bank_id, db.player.map_id))
         return -1
-    yield from toAny(connection.exits)
+    yield from toAny(connection.exits, path=path)
     yield from step(io.directions[ctype - 1])
     return 0
 
-def toWarp(info):
+def toWarp(info, path=None):
     """
     toWarp(info)    Leave the map by using the specified warp
     info: either WarpEvent, or phys_warp index
@@ -220,7 +255,7 @@ def toWarp(info):
     if (warp := world.WarpEvent.get(info)) is None:
         return -1
     max_dist = (m.map_status[warp.y, warp.x] == world.Status.OBSTACLE)
-    if (yield from toPos(warp.x, warp.y, max_dist)) == -1:
+    if (yield from toPos(warp.x, warp.y, max_dist, path)) == -1:
         return -1
 
     if p.bank_id == warp.dest_bank and p.map_id == warp.dest_map:
@@ -10,17 +10,27 @@ import interact
 import battle
 
 def follow(bot, path, explore=False):
-    for (xp, yp, bidp, midp), args in path:
+    for node in path:
+        (xp, yp, bidp, midp), args = node
+        if explore:
+            yield from bot.exploreMap()
+        # Legs are only refined into tiles once they are walked. Refined paths start at
+        # the node, connections can be entered anywhere and are searched live otherwise.
+        p = db.player
+        leg_path = None
+        if (p.x, p.y, p.bank_id, p.map_id) == (xp, yp, bidp, midp):
+            if (leg_path := Metafinder.getLegPath(node)) is None:
+                print("follow: no refined path to %s from (%d,%d), searching again" % (args, xp, yp))
+                # Costs may have been computed before NPCs blocked the way
+                Metafinder.invalidate([(bidp, midp)])
         if type(args) is world.Connection:
-            func = movement.toConnection(args)
+            func = movement.toConnection(args, leg_path)
         elif type(args) is world.WarpEvent:
-            func = movement.toWarp(args)
+            func = movement.toWarp(args, leg_path)
         elif type(args) is world.PersonEvent:
-            func = movement.toPers(args)
+            func = movement.toPers(args, path=leg_path)
         else:
-            func = movement.toPos(*args)
-        if explore:
-            yield from bot.exploreMap()
+            func = movement.toPos(*args, path=leg_path)
         if (yield from func) == -1:
             return -1
 
@@ -0,0 +1,118 @@
+import numpy as np
+import database; db = database.Database
+
+class BattleMath:
+    """
+    Vectorized damage, accuracy and catch formulas.
+    Every function takes an attacking pokemon, a list of targets and optionally
+    a list of move ids, and returns arrays indexed by (move, target[, roll]).
+    Pokemons can be BattleData or PokemonData objects.
+    """
+    ROLLS = np.arange(85, 101) / 100 # Random damage multipliers, all equally likely
+    CRIT_CHANCE = 1 / 16
+    CRIT_MULTIPLIER = 2
+    move_table = None
+
+    def getMoveTable():
+        """ Arrays of move attributes indexed by move id, built on first use """
+        if BattleMath.move_table is None:
+            moves = db.moves
+            BattleMath.move_table = {
+                "power": np.array([m.power for m in moves], dtype=float),
+                "accuracy": np.array([m.accuracy for m in moves], dtype=float),
+                "special": np.array([m.isSpecial() for m in moves], dtype=bool)}
+        return BattleMath.move_table
+
+    def getMoveIds(poke):
+        """ Ids of the known moves of a pokemon, in move slot order """
+        ids = poke.move_ids if hasattr(poke, "move_ids") else poke.attacks.move_ids
+        return np.array([i for i in ids if 0 < i < len(db.moves)], dtype=int)
+
+    def getSpeciesId(poke):
+        return poke.species_idx if hasattr(poke, "species_idx") else poke.growth.species_idx
+
+    def getTeamMoves(pokes):
+        """ Move ids of a list of pokemons, shape (pokemon, 4), empty slots being move 0 """
+        ids = [p.move_ids if hasattr(p, "move_ids") else p.attacks.move_ids for p in pokes]
+        ids = np.array(ids, dtype=int).reshape(len(pokes), 4)
+        return np.where(ids < len(db.moves), ids, 0)
+
+    def _getMultiplier(n, d):
+        r = (np.abs(n) + d) / d
+        return np.where(n < 0, 1 / r, r)
+
+    def getStats(pokes):
+        """ Arrays of the battle stats of a list of pokemons, buffs included """
+        def get(attr):
+            return np.array([getattr(p, attr) for p in pokes], dtype=float)
+        mult = BattleMath._getMultiplier
+        return {"level": get("level"),
+                "atk": get("atk") * mult(get("atk_buff"), 2),
+                "defense": get("defense") * mult(get("def_buff"), 2),
+                "spatk": get("spatk") * mult(get("spatk_buff"), 2),
+                "spdef": get("spdef") * mult(get("spdef_buff"), 2),
+                "accuracy": mult(get("accuracy_buff"), 3),
+                "evasion": mult(get("evasion_buff"), 3),
+                "species": np.array([BattleMath.getSpeciesId(p) for p in pokes], dtype=int),
+                "curr_hp": get("curr_hp"),
+                "max_hp": get("max_hp")}
+
+    def _getArgs(attacker, targets, moves):
+        if moves is None:
+            moves = BattleMath.getMoveIds(attacker)
+        return (BattleMath.getStats([attacker]), BattleMath.getStats(targets),
+                np.asarray(moves, dtype=int), BattleMath.getMoveTable())
+
+    def baseDamage(attacker, targets, moves=None):
+        """ Maximum damage (without critical hit) of each move on each target, shape (move, target) """
+        a, t, moves, table = BattleMath._getArgs(attacker, targets, moves)
+        power = table["power"][moves][:,None]
+        special = table["special"][moves][:,None]
+        atk = np.where(special, a["spatk"], a["atk"])
+        defense = np.where(special, t["spdef"][None,:], t["defense"][None,:])
+        stab = db.getStab(moves[:,None], a["species"])
+        eff = db.getEffectiveness(moves[:,None], t["species"][None,:])
+        dmg = 2.0 * a["level"] / 5.0 + 2
+        dmg = (dmg * atk * power) / defense
+        dmg = (dmg / 50.0) + 2
+        dmg = dmg * stab * eff
+        return np.where(power > 0, dmg, 0)
+
+    def damage(attacker, targets, moves=None):
+        """ Damage of each move on each target for every random roll, shape (move, target, roll) """
+        return BattleMath.baseDamage(attacker, targets, moves)[:,:,None] * BattleMath.ROLLS
+
+    def hitChance(attacker, targets, moves=None):
+        """ Probability of each move hitting each target, shape (move, target) """
+        a, t, moves, table = BattleMath._getArgs(attacker, targets, moves)
+        acc = table["accuracy"][moves][:,None]
+        chance = acc / 100 * a["accuracy"] / t["evasion"][None,:]
+        # Moves with no accuracy never miss
+        return np.where(acc == 0, 1.0, np.clip(chance, 0, 1))
+
+    def koChance(attacker, targets, moves=None, crit=True):
+        """ Probability of each move knocking out each target in one hit, shape (move, target) """
+        dmg = BattleMath.damage(attacker, targets, moves)
+        hp = BattleMath.getStats(targets)["curr_hp"][None,:,None]
+        ko = np.mean(dmg >= hp, axis=2)
+        if crit:
+            ko_crit = np.mean(dmg * BattleMath.CRIT_MULTIPLIER >= hp, axis=2)
+            ko = (1 - BattleMath.CRIT_CHANCE) * ko + BattleMath.CRIT_CHANCE * ko_crit
+        ko = np.where(np.max(dmg, axis=2) > 0, ko, 0)
+        return ko * BattleMath.hitChance(attacker, targets, moves)
+
+    def catchChance(targets, balls):
+        """ Probability of catching each target with each pokeball, shape (target, ball) """
+        t = BattleMath.getStats(targets)
+        species_rate = np.array([p.species.catch_rate for p in targets], dtype=float)[:,None]
+        ball_ids = np.array([b if type(b) is int else b.index for b in balls])
+        ball_rate = np.select([ball_ids == db.items.great_ball.index,
+                               ball_ids == db.items.ultra_ball.index,
+                               ball_ids == db.items.master_ball.index],
+                              [1.5, 2.0, 255.0], 1.0)[None,:]
+        bonus_status = np.array([2.0 if p.isSleeping() or p.isFrozen() else
+                                 1.5 if p.status != 0 else 1.0 for p in targets])[:,None]
+        max_hp = t["max_hp"][:,None]
+        rate = (3*max_hp - 2*t["curr_hp"][:,None]) * species_rate * ball_rate
+        rate = (rate / (3 * max_hp)) * bonus_status
+        return np.minimum(rate / 255, 1.0)
@@ -0,0 +1,68 @@
+import os
+import pickle
+import hashlib
+import numpy as np
+import memory; mem = memory.Memory
+
+class Cache(object):
+    """
+    On-disk storage for data derived from the ROM.
+    The ROM is immutable, so entries are keyed by its md5 and only discarded
+    when their format version changes.
+    """
+    path = None
+    rom_hash = None
+
+    def init(path=os.path.expanduser("~/.cache/pypokebot")):
+        Cache.path = path
+        Cache.rom_hash = hashlib.md5(mem.rom.buf).hexdigest()
+
+    def isEnabled():
+        return Cache.path is not None
+
+    def getDir():
+        return os.path.join(Cache.path, Cache.rom_hash)
+
+    def getPath(name):
+        return os.path.join(Cache.getDir(), name)
+
+    def load(name, version):
+        """
+        Return the object stored under 'name',
+        or None if it is missing or was written with another format version
+        """
+        if not Cache.isEnabled() or not os.path.exists(Cache.getPath(name + ".pickle")):
+            return None
+        try:
+            with open(Cache.getPath(name + ".pickle"), "rb") as f:
+                stored_version, obj = pickle.load(f)
+        except Exception as e:
+            print("cache error: cannot load %s: %s" % (name, e))
+            return None
+        if stored_version != version:
+            return None
+        return obj
+
+    def save(name, version, obj):
+        if not Cache.isEnabled():
+            return
+        os.makedirs(Cache.getDir(), exist_ok=True)
+        # Write to a temporary file first so that concurrent bots never read partial data
+        tmp_path = Cache.getPath("%s.pickle.%d" % (name, os.getpid()))
+        with open(tmp_path, "wb") as f:
+            pickle.dump((version, obj), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, Cache.getPath(name + ".pickle"))
+
+    def loadArray(name):
+        """ Memory-map an array stored with saveArray, or return None """
+        if not Cache.isEnabled() or not os.path.exists(Cache.getPath(name + ".npy")):
+            return None
+        return np.load(Cache.getPath(name + ".npy"), mmap_mode="r")
+
+    def saveArray(name, array):
+        if not Cache.isEnabled():
+            return
+        os.makedirs(Cache.getDir(), exist_ok=True)
+        tmp_path = Cache.getPath("%s.%d.npy" % (name, os.getpid()))
+        np.save(tmp_path, array)
+        os.replace(tmp_path, Cache.getPath(name + ".npy"))
@@ -4,8 +4,10 @@ import enum
 import utils
 import world
 import memory; mem = memory.Memory
+from cache import Cache
 import core.io; io = core.io.IO
 import re
+import threading
 
 class Database():
     class PlayerState(enum.IntEnum):
@@ -36,65 +38,26 @@ class Database():
         LEGENDARY_FRLG = 1 << 18
         TRAINER_TOWER = 1 << 19
 
-    def init():
-        Database.species_names = mem.readPokeList(0x8245EE0, 11, b'\xae\xff')
-        Database.move_names = mem.readPokeList(0x8247094, 13, b'\x00')
-        Database.ability_names = mem.readPokeList(0x824FC4D, 13, b'\x00')
-        Database.type_names = mem.readPokeList(0x824F1A0, 7, b'\x00')
-
-        Database.moves = NamedDataList([Move(0x08250C04+i*12, n) for i, n in enumerate(Database.move_names)])
-        Database.species = NamedDataList([Species(0x08254784+i*28, n) for i, n in enumerate(Database.species_names)])
-        Database.items = NamedDataList(utils.rawArray(Item, 0x083DB028, 375))
-        Database.trainers = utils.rawArray(Trainer, 0x0823EAC8, 743)
+    CACHE_VERSION = 2
+    # ROM-derived attributes stored in the on-disk cache
+    rom_data = ["species_names", "move_names", "ability_names", "type_names",
+                "moves", "species", "items", "trainers", "type_chart", "banks"]
+    tile_arrays = [("map_data", np.uint16), ("map_attrs", np.uint32), ("map_blocks", np.uint16)]
 
-        # Type effectiveness chart
-        Database.type_chart = np.ones((18, 18))
-        addr = 0x0824F050
-        t1, t2, code = mem.unpack(addr, "3B")
-        while t1 != 0xFF:
-            if t1 < 18 and t2 < 18:
-                val = 1
-                if code == 0x14:
-                    val = 2
-                elif code == 0x05:
-                    val = 0.5
-                elif code == 0x00:
-                    val = 0
-                Database.type_chart[t1, t2] = val
-            addr += 3
-            t1, t2, code = mem.unpack(addr, "3B")
+    def init(lazy=False):
+        """
+        Load static data, from the cache if available
+        lazy: only build maps when they are first accessed
+        Returns True if maps remain to be built, see warmUp
+        """
+        pending = False
+        if not Database.loadCache():
+            Database.loadRom(lazy)
+            if not lazy:
+                Database.saveCache()
+            pending = lazy
+        Database.buildTypeTables()
 
-        # World and map data
-        bankptr = 0x83526A8
-        rel, nxt = mem.unpack(bankptr, "2I")
-        Database.banks = []
-        while nxt > 0x8000000:
-            maps = []
-            for addr in range(rel, nxt, 4):
-                maps.append(world.Map(mem.readU32(addr), len(Database.banks), len(maps)))
-            Database.banks.append(maps)
-            rel, nxt = mem.unpack(bankptr + len(Database.banks) * 4, "2I")
-        # Load map exits in memory
-        for bank in Database.banks:
-            for m in bank:
-                for connect in m.connects:
-                    connect.findExits(m)
-        # Load wild battle data
-        wildptr = 0x083c9cb8
-        while True:
-            unpacked = mem.unpack(wildptr, "2B2x4I")
-            bank_id, map_id = unpacked[:2]
-            entry_ptrs = unpacked[2:]
-            if bank_id == 0xFF or map_id == 0xFF:
-                break
-            m = Database.banks[bank_id][map_id]
-            for i in range(4):
-                if entry_ptrs[i] != 0:
-                    wb = m.wild_battles[i]
-                    wb.ratio, mon_ptr = mem.unpack(entry_ptrs[i], "B3xI")
-                    nentries = (entry_ptrs[i] - mon_ptr) // 4
-                    wb.entries = utils.rawArray(world.WildEntry, mon_ptr, nentries)
-            wildptr += 20
         # Warp behaviors and necessary key to enter warp
         Database.warp_behaviors = {
             0x60: io.Key.UP,    # Cave door
@@ -138,6 +101,149 @@ class Database():
 
         # Battle
         Database.battle_context = BattleContext()
+        return pending
+
+    def loadRom(lazy=False):
+        """
+        Read all static data from the ROM
+        If lazy is set, maps are only built when first accessed
+        """
+        Database.species_names = mem.readPokeList(0x8245EE0, 11, b'\xae\xff')
+        Database.move_names = mem.readPokeList(0x8247094, 13, b'\x00')
+        Database.ability_names = mem.readPokeList(0x824FC4D, 13, b'\x00')
+        Database.type_names = mem.readPokeList(0x824F1A0, 7, b'\x00')
+
+        Database.moves = NamedDataList([Move(0x08250C04+i*12, n) for i, n in enumerate(Database.move_names)])
+        Database.species = NamedDataList([Species(0x08254784+i*28, n) for i, n in enumerate(Database.species_names)])
+        Database.items = NamedDataList(utils.rawArray(Item, 0x083DB028, 375))
+        Database.trainers = utils.rawArray(Trainer, 0x0823EAC8, 743)
+
+        # Type effectiveness chart
+        Database.type_chart = np.ones((18, 18))
+        addr = 0x0824F050
+        t1, t2, code = mem.unpack(addr, "3B")
+        while t1 != 0xFF:
+            if t1 < 18 and t2 < 18:
+                val = 1
+                if code == 0x14:
+                    val = 2
+                elif code == 0x05:
+                    val = 0.5
+                elif code == 0x00:
+                    val = 0
+                Database.type_chart[t1, t2] = val
+            addr += 3
+            t1, t2, code = mem.unpack(addr, "3B")
+
+        # Wild battle headers, applied to maps when they are built
+        Database.wild_ptrs = {}
+        wildptr = 0x083c9cb8
+        while True:
+            unpacked = mem.unpack(wildptr, "2B2x4I")
+            bank_id, map_id = unpacked[:2]
+            if bank_id == 0xFF or map_id == 0xFF:
+                break
+            Database.wild_ptrs[(bank_id, map_id)] = unpacked[2:]
+            wildptr += 20
+
+        # World and map data
+        bankptr = 0x83526A8
+        rel, nxt = mem.unpack(bankptr, "2I")
+        Database.banks = []
+        while nxt > 0x8000000:
+            addrs = [mem.readU32(addr) for addr in range(rel, nxt, 4)]
+            Database.banks.append(MapBank(len(Database.banks), addrs))
+            rel, nxt = mem.unpack(bankptr + len(Database.banks) * 4, "2I")
+        if lazy:
+            return
+        # Load all maps and their exits in memory
+        for bank in Database.banks:
+            for m in bank:
+                for connect in m.connects:
+                    connect.findExits(m)
+
+    def loadMap(bank_id, map_id, addr):
+        """ Build a map from the ROM, along with its wild battles """
+        m = world.Map(addr, bank_id, map_id)
+        entry_ptrs = Database.wild_ptrs.get((bank_id, map_id), [0] * 4)
+        for i in range(4):
+            if entry_ptrs[i] != 0:
+                wb = m.wild_battles[i]
+                wb.ratio, mon_ptr = mem.unpack(entry_ptrs[i], "B3xI")
+                nentries = (entry_ptrs[i] - mon_ptr) // 4
+                wb.entries = utils.rawArray(world.WildEntry, mon_ptr, nentries)
+        return m
+
+    def warmUp():
+        """
+        Build all remaining maps and exits in a background thread
+        The cache is saved once every map is loaded
+        """
+        def _warmUp():
+            for bank in Database.banks:
+                for m in bank:
+                    for connect in m.connects:
+                        connect.exits
+            # Pickled under the lock so that the main thread cannot change the banks meanwhile
+            with MapBank.lock:
+                Database.saveCache()
+        Database.warmup_thread = threading.Thread(target=_warmUp, daemon=True)
+        Database.warmup_thread.start()
+
+    def loadCache():
+        """
+        Restore static data from the on-disk cache
+        Tile arrays are memory-mapped and shared by all maps
+        Returns False if the cache is missing or outdated
+        """
+        if (data := Cache.load("database", Database.CACHE_VERSION)) is None:
+            return False
+        arrays = [Cache.loadArray(name) for name, dtype in Database.tile_arrays]
+        if any([x is None for x in arrays]):
+            return False
+        for name in Database.rom_data:
+            setattr(Database, name, data[name])
+        offset = 0
+        for bank in Database.banks:
+            for m in bank:
+                sz = m.width * m.height
+                m.loadTiles(*[x[offset:offset+sz].reshape(m.height, m.width) for x in arrays])
+                offset += sz
+        return True
+
+    def saveCache():
+        if not Cache.isEnabled():
+            return
+        for name, dtype in Database.tile_arrays:
+            tiles = [getattr(m, name).flatten() for bank in Database.banks for m in bank]
+            Cache.saveArray(name, np.concatenate(tiles).astype(dtype))
+        data = {name: getattr(Database, name) for name in Database.rom_data}
+        data["banks"] = [list(bank) for bank in Database.banks]
+        Cache.save("database", Database.CACHE_VERSION, data)
+
+    def buildTypeTables():
+        """
+        Precompute type effectiveness and STAB multipliers for every move/species pair
+        Both tables are indexed by [move_id, species_id]
+        """
+        move_types = np.array([m.type for m in Database.moves], dtype=int)[:,None]
+        type1 = np.array([s.type1 for s in Database.species], dtype=int)[None,:]
+        type2 = np.array([s.type2 for s in Database.species], dtype=int)[None,:]
+        chart = Database.type_chart
+        eff = chart[move_types, type1]
+        Database.effectiveness = eff * np.where(type1 != type2, chart[move_types, type2], 1)
+        Database.stab = 1 + 0.5 * ((move_types == type1) | (move_types == type2))
+
+    def getEffectiveness(move_ids, species_ids):
+        """
+        Type effectiveness of moves against defending species
+        Arguments are arrays of ids broadcast together, e.g. (party, 4) moves against (party, 1) species
+        """
+        return Database.effectiveness[np.asarray(move_ids), np.asarray(species_ids)]
+
+    def getStab(move_ids, species_ids):
+        """ Same type attack bonus of moves used by attacking species, broadcast like getEffectiveness """
+        return Database.stab[np.asarray(move_ids), np.asarray(species_ids)]
 
     def plotTypeEffectiveness():
         import matplotlib.pyplot as plt
@@ -308,8 +414,39 @@ class NamedDataList(list):
             key = re.sub("\W", "", x.name.lower().replace(" ", "_"))
             self.data[key] = x
     def __getattr__(self, key):
+        # Guard against lookups before 'data' is set, e.g. while unpickling
+        if key == "data" or key not in self.data:
+            raise AttributeError(key)
         return self.data[key]
 
+class MapBank(list):
+    """
+    List of maps from a single bank, each map is only built on first access
+    """
+    lock = threading.Lock()
+    def __init__(self, bank_id, addrs):
+        super().__init__([None] * len(addrs))
+        self.bank_id = bank_id
+        self.addrs = addrs
+
+    def __getitem__(self, idx):
+        if type(idx) is slice:
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if (m := list.__getitem__(self, idx)) is None:
+            with MapBank.lock:
+                if (m := list.__getitem__(self, idx)) is None:
+                    idx %= len(self)
+                    m = Database.loadMap(self.bank_id, idx, self.addrs[idx])
+                    list.__setitem__(self, idx, m)
+        return m
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def isLoaded(self, idx):
+        return list.__getitem__(self, idx) is not None
+
 class OWObject(utils.RawStruct, utils.AutoUpdater):
     """
     Overworld Objects such as people, pickable objects, etc.
@@ -1,5 +1,4 @@
 import enum
-import pygame
 
 class IO(object):
     class Key(enum.IntEnum):
@@ -24,6 +23,16 @@ class IO(object):
         IO.core = core
 
         IO.turbo = False
+
+        IO.directions = [IO.Key.DOWN,
+                         IO.Key.UP,
+                         IO.Key.LEFT,
+                         IO.Key.RIGHT]
+
+    def initKeymap():
+        """ Keyboard bindings of the window, pygame is only needed when playing in one """
+        import pygame
+        core = IO.core
         IO.keymap = [(pygame.K_UP, core.KEY_UP),
                      (pygame.K_DOWN, core.KEY_DOWN),
                      (pygame.K_LEFT, core.KEY_LEFT),
@@ -35,11 +44,6 @@ class IO(object):
                      (pygame.K_RETURN, core.KEY_START),
                      (pygame.K_BACKSPACE, core.KEY_SELECT)]
 
-        IO.directions = [IO.Key.DOWN,
-                         IO.Key.UP,
-                         IO.Key.LEFT,
-                         IO.Key.RIGHT]
-
     def getRaw():
         return IO.core._core.getKeys(IO.core._core)
     def setRaw(keys):
@@ -23,6 +23,7 @@ class Buffer():
 class Memory(object):
     def init(core):
         Memory.core = core
+        Memory.frame_offset = 0 # Keeps frame_counter increasing when loading older states
         Memory.frame_counter = Memory.core.frame_counter
 
         Memory.wram = Buffer(2, (lambda: core._native.memory.wram), core.memory.wram.size)
@@ -267,7 +268,7 @@ class Memory(object):
         print(out, end="")
 
     def updateBuffers():
-        Memory.frame_counter = Memory.core.frame_counter
+        Memory.frame_counter = Memory.core.frame_counter + Memory.frame_offset
         for buf in Memory.memmap:
             if buf is not None:
                 buf.update()
@@ -1,3 +1,5 @@
+import heapq
+import itertools
 import numpy as np
 import database; db = database.Database
 import core.io; io = core.io.IO
@@ -6,96 +8,209 @@ import world
 import player
 
 class Metafinder:
-    subpaths = {} # Dict of pair accessibility within a map
+    subpaths = {} # Walking cost of each leg within a map, np.inf if unreachable
+    portals = {} # Legs leaving each map, and the portal they lead to
+    edges = {} # Portals reachable from each portal, with their cost
+    leg_paths = {} # Tile paths of the legs refined so far
+    dependents = {} # Legs to invalidate when a flag, variable or map overworlds change
+    map_dependencies = {} # Flags and variables which can change obstacles in each map
 
-    def _subSearch(start_key, checker):
+    def _getDependencies(m):
         """
-        Returns a valid path from start_key, validated by the function 'checker'
-        start_key: (x, y, bank_id, map_id)
-        checker:
-        - called for each new visited node
-        - args: list of nodes to visit, current node
-        - returns: True if the current path has reached the target, False otherwise
-        - notes: the checker should add a path to a precise location to 'to_visit' once the right map has been found
+        Flags and variables deciding the obstacles of a map:
+        person visibility and trigger scripts
         """
-        def checkPath(path):
-            for node in path:
-                if node in Metafinder.subpaths:
-                    if Metafinder.subpaths[node]:
-                        continue
-                    else:
-                        return False, node
-                (xp, yp, bidp, midp), args = node
-                m = db.banks[bidp][midp]
-                finder = m.getPathfinder()
-                ret = None
-                if type(args) is world.Connection:
-                    ret = finder.searchConnection(xp, yp, args)
-                elif type(args) is world.WarpEvent:
-                    max_dist = (m.map_status[args.y, args.x] == world.Status.OBSTACLE)
-                    ret = finder.searchWarp(xp, yp, args, max_dist)
-                elif type(args) is world.PersonEvent:
-                    ret = finder.searchPers(xp, yp, args)
-                else:
-                    xe, ye = args
-                    ret = finder.searchPos(xp, yp, xe, ye)
-                Metafinder.subpaths[node] = (ret is not None)
-                if ret is None:
-                    return False, node
-            return True, None
-
-        to_visit = [(start_key, [], [])]
-        while len(to_visit):
-            curr_node = to_visit.pop(0)
-            curr_key, path, meta_mem = curr_node
-            (xc, yc, bidc, midc) = curr_key
-            if checker(to_visit, curr_node):
-                is_valid, failure_node = checkPath(path)
-                if is_valid:
-                    return path
-                # Prune candidates containing the unreachable node
-                to_visit = [cand for cand in to_visit if failure_node not in cand[1]]
+        if (m.bank_id, m.map_id) in Metafinder.map_dependencies:
+            return Metafinder.map_dependencies[m.bank_id, m.map_id]
+        deps = set()
+        for pers in m.persons:
+            if pers.idx != 0:
+                deps.add(Script.Flag(pers.idx))
+        for s in m.scripts:
+            if Script.isVar(s.var_nb):
+                deps.add(Script.Var(s.var_nb))
+            if (sscript := Script.getScript(s.data_idx, m.bank_id, m.map_id)) is not None:
+                deps.update(sscript.inputs.filter(Script.Flag) | sscript.inputs.filter(Script.Var))
+        Metafinder.map_dependencies[m.bank_id, m.map_id] = deps
+        return deps
+
+    def _isActive(m):
+        """ Whether overworlds of the map are loaded, and count as obstacles """
+        return m.bank_id == db.player.bank_id and m.map_id == db.player.map_id
+
+    def _addDependencies(node, m):
+        """ Register what a cached leg depends on """
+        deps = Metafinder._getDependencies(m)
+        # Overworlds of the active map are obstacles as well
+        if Metafinder._isActive(m):
+            deps = deps | {(m.bank_id, m.map_id)}
+        for dep in deps:
+            Metafinder.dependents.setdefault(dep, set()).add(node)
+
+    def invalidate(changed):
+        """
+        Forget the legs depending on a list of changed flags/variables,
+        or on the overworlds of a (bank_id, map_id) map
+        """
+        for dep in changed:
+            for node in Metafinder.dependents.pop(dep, ()):
+                key, args = node
+                Metafinder.subpaths.pop(node, None)
+                Metafinder.leg_paths.pop(node, None)
+                Metafinder.edges.pop(key, None)
+
+    def _getPortals(bank_id, map_id):
+        """
+        Returns the ways out of a map as a list of (args, dest_key)
+        args: Connection or WarpEvent to reach in the map
+        dest_key: (x, y, bank_id, map_id) of the arrival tile
+        """
+        if (bank_id, map_id) in Metafinder.portals:
+            return Metafinder.portals[bank_id, map_id]
+        m = db.banks[bank_id][map_id]
+        portals = []
+        blacklist = set()
+        # Map connections
+        for conn in m.connects:
+            # TODO: conn.exits should not have 0 length
+            # TODO: investigate for map [3,41]
+            dest_conn = conn.getMatchingConnection()
+            if len(conn.exits) == 0 or len(dest_conn.exits) == 0:
+                continue
+            # TODO: can a connection lead to different parts of a map?
+            entry_x, entry_y = dest_conn.exits[0]
+            dest_key = (entry_x, entry_y, conn.dest_bank, conn.dest_map)
+            if dest_key in blacklist:
+                continue
+            blacklist.add(dest_key)
+            portals.append((conn, dest_key))
+        # Warps
+        blacklist = set()
+        for warp in m.warps:
+            dest_warp = db.banks[warp.dest_bank][warp.dest_map].warps[warp.dest_warp]
+            # TODO: dest_warp.dest_warp should be valid
+            # TODO: investigate for map [0,1]
+            if dest_warp.dest_warp > len(m.warps):
+                continue
+            back_warp = m.warps[dest_warp.dest_warp]
+            dest_key = (dest_warp.x, dest_warp.y, warp.dest_bank, warp.dest_map)
+            if dest_key in blacklist:
                 continue
+            blacklist.add(dest_key)
+            portals.append((back_warp, dest_key))
+        Metafinder.portals[bank_id, map_id] = portals
+        return portals
 
-            m = db.banks[bidc][midc]
-            blacklist = set()
-            # Explore map connections
-            for conn in m.connects:
-                # TODO: conn.exits should not have 0 length
-                # TODO: investigate for map [3,41]
-                dest_conn = conn.getMatchingConnection()
-                if len(conn.exits) == 0 or len(dest_conn.exits) == 0:
-                    continue
-                # TODO: can a connection lead to different parts of a map?
-                exit_x, exit_y = conn.exits[0]
-                entry_x, entry_y = dest_conn.exits[0]
-                conn_key = (exit_x, exit_y, bidc, midc)
-                dest_key = (entry_x, entry_y, conn.dest_bank, conn.dest_map)
-                if dest_key in meta_mem or dest_key in blacklist:
-                    continue
-                blacklist.add(dest_key)
-                to_visit.append((dest_key,
-                                 path + [(curr_key, conn)],
-                                 meta_mem + [conn_key, dest_key]))
-            # Explore warps
-            blacklist = set()
-            for warp in m.warps:
-                dest_warp = db.banks[warp.dest_bank][warp.dest_map].warps[warp.dest_warp]
-                # TODO: dest_warp.dest_warp should be valid
-                # TODO: investigate for map [0,1]
-                if dest_warp.dest_warp > len(m.warps):
-                    continue
-                back_warp = m.warps[dest_warp.dest_warp]
-                warp_key = (back_warp.x, back_warp.y, bidc, midc)
-                dest_key = (dest_warp.x, dest_warp.y, warp.dest_bank, warp.dest_map)
-                if dest_key in meta_mem or dest_key in blacklist:
-                    continue
-                blacklist.add(dest_key)
-                to_visit.append((dest_key,
-                                 path + [(curr_key, back_warp)],
-                                 meta_mem + [warp_key, dest_key]))
+    def _getCost(node):
+        """
+        Walking cost of a leg within a map, np.inf if unreachable
+        node: ((x, y, bank_id, map_id), args), args being the target of the leg
+        """
+        if node in Metafinder.subpaths:
+            return Metafinder.subpaths[node]
+        (xp, yp, bidp, midp), args = node
+        m = db.banks[bidp][midp]
+        locs, dist = Metafinder._getTarget(m, args)
+        # Distance fields are cached by the pathfinder, legs to the same target share them
+        cost = m.getPathfinder().getCost(xp, yp, locs, dist)
+        # NPCs may only be in the way for now, such legs are not kept
+        if cost == np.inf and Metafinder._isActive(m):
+            return cost
+        Metafinder.subpaths[node] = cost
+        Metafinder._addDependencies(node, m)
+        return cost
+
+    def _getTarget(m, args):
+        """ Tiles to reach for a leg in map 'm', and the distance to keep from them """
+        if type(args) is world.Connection:
+            return args.exits, 0
+        elif type(args) is world.WarpEvent:
+            return [[args.x, args.y]], (m.map_status[args.y, args.x] == world.Status.OBSTACLE)
+        elif type(args) is world.PersonEvent:
+            return [[args.x, args.y]], 1
+        return [args], 0
+
+    def _getEdges(key):
+        """
+        Returns the portals reachable by walking from 'key' as a list of (cost, args, dest_key)
+        Costs include the step crossing the warp or connection
+        """
+        if key in Metafinder.edges:
+            return Metafinder.edges[key]
+        (x, y, bank_id, map_id) = key
+        edges = []
+        complete = True
+        for args, dest_key in Metafinder._getPortals(bank_id, map_id):
+            if (cost := Metafinder._getCost((key, args))) != np.inf:
+                edges.append((cost + 1, args, dest_key))
+            elif (key, args) not in Metafinder.subpaths:
+                complete = False
+        # Only keep edges when no leg is waiting for NPCs to move
+        if complete:
+            Metafinder.edges[key] = edges
+        return edges
+
+    def getLegPath(node):
+        """
+        Returns the tile path of a leg, computed the first time it is needed
+        node: ((x, y, bank_id, map_id), args), as found in Metafinder paths
+        """
+        if node in Metafinder.leg_paths:
+            return Metafinder.leg_paths[node]
+        (xp, yp, bidp, midp), args = node
+        m = db.banks[bidp][midp]
+        locs, dist = Metafinder._getTarget(m, args)
+        # Failures may come from moving NPCs and are not kept
+        if (path := m.getPathfinder().searchAny(xp, yp, np.array(locs), dist)) is not None:
+            Metafinder.leg_paths[node] = path
+            Metafinder._addDependencies(node, m)
+        return path
+
+    def _subSearch(start_key, targets):
+        """
+        Returns the cheapest path from start_key to a target
+        start_key: (x, y, bank_id, map_id)
+        targets:
+        - called for each visited node
+        - args: current node key
+        - returns: the final legs [(args, key)] starting from the current node,
+          args being None if the node itself is a target
+        """
+        # Nodes are (key, is_target), targets are only reached through their final leg
+        push_count = itertools.count()
+        start = (start_key, False)
+        costs = {start: 0}
+        prevs = {start: None}
+        openset = [(0, next(push_count), start)]
+        while len(openset):
+            cost, _, curr = heapq.heappop(openset)
+            if cost > costs[curr]:
+                continue
+            curr_key, is_target = curr
+            if is_target:
+                return Metafinder._rebuildPath(curr, prevs)
+            legs = []
+            for args, key in targets(curr_key):
+                leg_cost = 0 if args is None else Metafinder._getCost((curr_key, args))
+                legs.append((leg_cost, args, (key, True)))
+            # Portal to portal costs are cached, the map itself is not searched again
+            for leg_cost, args, key in Metafinder._getEdges(curr_key):
+                legs.append((leg_cost, args, (key, False)))
+            for leg_cost, args, nxt in legs:
+                if cost + leg_cost < costs.get(nxt, np.inf):
+                    costs[nxt] = cost + leg_cost
+                    prevs[nxt] = (curr, args)
+                    heapq.heappush(openset, (costs[nxt], next(push_count), nxt))
         return None
 
+    def _rebuildPath(node, prevs):
+        path = []
+        while prevs[node] is not None:
+            node, args = prevs[node]
+            if args is not None:
+                path.append((node[0], args))
+        return path[::-1]
+
     def _getStart(info=None):
         if info is None:
             info = db.player
@@ -110,56 +225,45 @@ class Metafinder:
         return Metafinder._getStart()
 
     def search(xe, ye, bide, mide, start=None):
-        def checker(to_visit, node, tgt_key):
-            curr_key, path, meta_mem = node
+        def targets(curr_key, tgt_key):
             # Exact target has been reached
             if curr_key == tgt_key:
-                return True
+                return [(None, tgt_key)]
             (xc, yc, bidc, midc) = curr_key
             (xe, ye, bide, mide) = tgt_key
-            # Destination map reached, add final path to the list
+            # Destination map reached, add final path
             if bidc == bide and midc == mide:
-                to_visit.insert(0, (tgt_key,
-                                    path + [(curr_key, (xe, ye))],
-                                    meta_mem))
-            return False
+                return [((xe, ye), tgt_key)]
+            return []
 
         start_key = Metafinder._getStart(start)
         tgt_key = (xe, ye, bide, mide)
-        return Metafinder._subSearch(start_key, lambda *args: checker(*args, tgt_key))
+        return Metafinder._subSearch(start_key, lambda key: targets(key, tgt_key))
 
     def searchMap(bank_id, map_id, start=None):
-        def checker(to_visit, node):
-            curr_key, path, meta_mem = node
+        def targets(curr_key):
             (xc, yc, bidc, midc) = curr_key
             # Destination map reached
             if bidc == bank_id and midc == map_id:
-                return True
-            return False
+                return [(None, curr_key)]
+            return []
         start_key = Metafinder._getStart(start)
-        return Metafinder._subSearch(start_key, checker)
+        return Metafinder._subSearch(start_key, targets)
 
     def searchHealer(start=None):
-        def checker(to_visit, node):
-            curr_key, path, meta_mem = node
+        def targets(curr_key):
             (xc, yc, bidc, midc) = curr_key
             m = db.banks[bidc][midc]
             heal_instr = Script.CallSpecial(0x0)
-            # Exact target has been reached
-            if len(path):
-                key, args = path[-1]
-                # TODO: execute script and check that the heal is reachable
-                if type(args) is world.PersonEvent:
-                    return True
+            out = []
             # Add final path to person if they can heal the party
+            # TODO: execute script and check that the heal is reachable
             for pers in m.persons:
                 if (pscript := Script.getPerson(pers.evt_nb-1, bidc, midc)) is None:
                     continue
                 if heal_instr in pscript.outputs:
-                    to_visit.insert(0, ((pers.x, pers.y, bidc, midc),
-                                        path + [(curr_key, pers)],
-                                        meta_mem))
-            return False
+                    out.append((pers, (pers.x, pers.y, bidc, midc)))
+            return out
 
         start_key = Metafinder._getStart(start)
-        return Metafinder._subSearch(start_key, checker)
+        return Metafinder._subSearch(start_key, targets)
@@ -1,4 +1,8 @@
+import heapq
+import itertools
+import math
 import numpy as np
+import memory; mem = memory.Memory
 import database; db = database.Database
 import core.io; io = core.io.IO
 from script import Script, MvtScript
@@ -6,175 +10,164 @@ from script import Script, MvtScript
 class Pathfinder:
     mvt_static = [0, 1, 7, 8, 9, 10] + list(range(13, 25)) + list(range(64, 80))
 
-    class Node:
-        def __init__(self, m, coords):
-            self.map = m
-            self.x, self.y = coords
-            self.status = m.map_status[self.y, self.x]
-            self.tile = m.map_tile[self.y, self.x]
-            self.behavior = m.map_behavior[self.y, self.x]
-            self.left = self.right = None
-            self.up = self.down = None
-            self.scripts = []
-            self.setMovementCost()
-            self.clear()
-
-        def isWalkable(self):
-            return (self.status in [0x0C, 0x00, 0x10] and   # Walkable tile
-                    self.behavior not in [0x61, 0x6B])      # Not escalator
-
-        def hasOverWorld(self):
-            if self.ow is not None:
-                return self.ow
-            checked = [False] * len(self.map.persons)
-            bid = self.map.bank_id
-            mid = self.map.map_id
-            # If working on the active map, check dynamic overworlds
-            if bid == db.player.bank_id and mid == db.player.map_id:
-                for ow in db.ows[1:]: # Skip player overworld
-                    if ow.bank_id == 0 and ow.map_id == 0:
-                        break
-                    if ow.bank_id == bid and ow.map_id == mid:
-                        if ow.dest_x == self.x and ow.dest_y == self.y:
-                            self.ow = True
-                            return self.ow
-                        checked[ow.evt_nb-1] = True
-            for pers in self.map.persons:
-                if checked[pers.evt_nb-1]: # Already checked as overworld
-                    continue
-                if pers.x == self.x and pers.y == self.y and pers.isVisible():
-                    self.ow = True
-                    return self.ow
-            self.ow = False
-            return self.ow
-
-        def hasScriptMovement(self, ctx):
-            if self.script_mvmt is not None:
-                return self.script_mvmt
-            for s in self.scripts:
-                if ctx.getVar(s.var_nb, False) != s.var_val:
-                    continue
-                sscript = Script.getScript(s.data_idx, self.map.bank_id, self.map.map_id)
-                # is duplicating the context necessary here?
-                out_ctxs = sscript.execute(Script.Context(ctx))
-                for out_ctx in out_ctxs:
-                    for mvt_addr in out_ctx.outputs.filter(Script.Movement):
-                        mvt_script = MvtScript(int(mvt_addr))
-                        if mvt_script.dx != 0 or mvt_script.dy != 0:
-                            self.script_mvmt = True
-                            return self.script_mvmt
-            self.script_mvmt = False
-            return self.script_mvmt
-
-        def setMovementCost(self):
-            """ Sets movement cost """
-            terrain = self.map.map_terrain[self.y, self.x]
-            encounter = self.map.map_encounter[self.y, self.x]
-            self.movement_cost = 1.0
-            if terrain == 1 and encounter == 1: # Grass
-                self.movement_cost = 10.0
-
-        def connect(self, pth):
-            right = pth.getNode(self.x+1, self.y)
-            if right:
-                bhv = right.behavior
-                if bhv in [0x38, 0x39]: # Hills
-                    right = pth.getNode(self.x+2, self.y)
-                    if bhv == 0x38: # Right jump
-                        self.right = right
-                    elif right: # Left jump
-                        right.left = self
-                elif right.isWalkable():
-                    self.right = right
-                    right.left = self
-
-            down = pth.getNode(self.x, self.y+1)
-            if down:
-                if down.behavior == 0x3B: # Down jump
-                    self.down = pth.getNode(self.x, self.y+2)
-                elif down.isWalkable():
-                    self.down = down
-                    down.up = self
-
-        def disconnect(self):
-            """ Disconnect a node from its neighbors, in both directions """
-            if self.left:
-                self.left.right = None
-            if self.right:
-                self.right.left = None
-            if self.up:
-                self.up.down = None
-            if self.down:
-                self.down.up = None
-            self.left = self.right = None
-            self.up = self.down = None
-
-        def getNeighbors(self):
-            neighbs = [self.up, self.down, self.left, self.right]
-            return [x for x in neighbs if x]
-
-        def clear(self):
-            """
-            Clear weights and recorded path
-            Keeps links and other static data
-            """
-            self.weight = self.heuristic = 0
-            self.dist = 9999
-            self.prev = None
-            self.ow = None
-            self.script_mvmt = None
-
-        def setHeuristic(self, dist):
-            self.dist = dist
-            self.heuristic = self.weight + self.dist
+    # Adjacency bitmask, the upper 4 bits mark a direction as a 2 tiles ledge jump
+    UP = 0x01
+    DOWN = 0x02
+    LEFT = 0x04
+    RIGHT = 0x08
+    JUMP_SHIFT = 4
+    MAX_FIELDS = 32 # Distance fields cached per map
+    # Whether a trigger script moves the player, indexed by script key and input values
+    script_movements = {}
 
     def __init__(self, map_data):
         self.map = map_data
-        self.dirty = False
-        self.nodes = []
-        # Create nodes
-        for y in range(self.map.height):
-            rows = []
-            for x in range(self.map.width):
-                n = Pathfinder.Node(self.map, (x, y))
-                rows.append(n)
-            self.nodes.append(rows)
-        # Connect nodes
-        for y in range(self.map.height):
-            for x in range(self.map.width):
-                if not self.nodes[y][x].isWalkable():
-                    continue
-                self.nodes[y][x].connect(self)
-        # Remove unwalkable nodes
-        for y in range(self.map.height):
-            for x in range(self.map.width):
-                if not self.nodes[y][x].isWalkable():
-                    self.nodes[y][x] = None
+        w, h = self.map.width, self.map.height
+        status = self.map.map_status
+        behavior = self.map.map_behavior
+        # Static tile data, indexed by y * width + x
+        walkable = (np.isin(status, [0x0C, 0x00, 0x10]) &  # Walkable tile
+                    ~np.isin(behavior, [0x61, 0x6B]))      # Not escalator
+        grass = (self.map.map_terrain == 1) & (self.map.map_encounter == 1)
+        self.walkable = walkable.ravel()
+        self.movement_cost = np.where(grass, 10.0, 1.0).ravel()
+        self.adjacency = self._buildAdjacency(walkable, behavior).ravel()
+        # Neighbor order: up, down, left, right
+        self.steps = [(Pathfinder.UP, -w), (Pathfinder.DOWN, w),
+                      (Pathfinder.LEFT, -1), (Pathfinder.RIGHT, 1)]
         # Register scripts
+        self.scripts = {}
         for s in self.map.scripts:
-            if (node := self.getNode(s.x, s.y)) is None:
+            if (idx := self.getIndex(s.x, s.y)) is None:
                 continue
-            node.scripts.append(s)
+            self.scripts.setdefault(idx, []).append(s)
+        self.heuristics = None
+        self.predecessors = None
+        self.fields = {} # Distance fields and their obstacles, indexed by target
+        self.occupancy = None
+        self.occupancy_frame = -1
+        self.clear()
 
-    def search(self, xs, ys, dist_func, dist=0, ctx=None):
+    def _buildAdjacency(self, walk, bhv):
         """
-        Returns the path from [xs,ys] to a given target
-        dist_func returns the distance to the target from a node
+        Build the movement bitmask of every tile
+        Ledges (0x38 right, 0x39 left, 0x3B down) can only be jumped over in their direction
         """
-        def unlock():
-            db.player.unlock()
-            database.OWObject.unlock()
+        adj = np.zeros(walk.shape, dtype=np.uint8)
+        up, down, left, right = [np.uint8(x) for x in [Pathfinder.UP, Pathfinder.DOWN,
+                                                       Pathfinder.LEFT, Pathfinder.RIGHT]]
+        shift = Pathfinder.JUMP_SHIFT
+        hill = (bhv == 0x38) | (bhv == 0x39)
+        # Walk between x and x+1
+        step = walk[:, :-1] & ~hill[:, 1:] & walk[:, 1:]
+        adj[:, :-1] |= right * step
+        adj[:, 1:] |= left * step
+        # Jump right from x to x+2
+        jump = walk[:, :-2] & (bhv[:, 1:-1] == 0x38)
+        adj[:, :-2] |= (right | right << shift) * jump
+        # Jump left from x+2 to x, unless x+2 can already walk left
+        jump = walk[:, :-2] & (bhv[:, 1:-1] == 0x39) & ~step[:, 1:]
+        adj[:, 2:] |= (left | left << shift) * jump
+        # Walk between y and y+1
+        step = walk[:-1] & (bhv[1:] != 0x3B) & walk[1:]
+        adj[:-1] |= down * step
+        adj[1:] |= up * step
+        # Jump down from y to y+2
+        jump = walk[:-2] & (bhv[1:-1] == 0x3B)
+        adj[:-2] |= (down | down << shift) * jump
+        return adj
 
-        if ctx is None:
-            ctx = Script.Context()
-        if self.dirty:
-            self.clear()
-        # Lock dynamic objects from updates
+    def getNeighbors(self, idx):
+        """ Indices reachable in one move from tile 'idx' """
+        mask = self.adjacency[idx]
+        out = []
+        for bit, step in self.steps:
+            if mask & bit:
+                out.append(idx + (step << 1 if mask & (bit << Pathfinder.JUMP_SHIFT) else step))
+        return out
+
+    def hasOverWorld(self, idx):
+        return self.getOccupancy()[idx]
+
+    def getOccupancy(self):
+        """
+        Flat mask of the tiles occupied by overworlds or visible persons
+        Rebuilt at most once per frame
+        """
+        if self.occupancy_frame == mem.frame_counter:
+            return self.occupancy
+        w, h = self.map.width, self.map.height
+        bid = self.map.bank_id
+        mid = self.map.map_id
+        xs, ys = [], []
+        checked = set()
+        # If working on the active map, use dynamic overworlds
+        if bid == db.player.bank_id and mid == db.player.map_id:
+            for ow in db.ows[1:]: # Skip player overworld
+                if ow.bank_id == 0 and ow.map_id == 0:
+                    break
+                if ow.bank_id == bid and ow.map_id == mid:
+                    xs.append(ow.dest_x)
+                    ys.append(ow.dest_y)
+                    checked.add(ow.evt_nb)
+        for pers in self.map.persons:
+            if pers.evt_nb in checked: # Already placed as overworld
+                continue
+            if pers.isVisible():
+                xs.append(pers.x)
+                ys.append(pers.y)
+        xs = np.array(xs, dtype=int)
+        ys = np.array(ys, dtype=int)
+        inside = (xs >= 0) & (xs < w) & (ys >= 0) & (ys < h)
+        self.occupancy = np.zeros(w * h, dtype=bool)
+        self.occupancy[ys[inside] * w + xs[inside]] = True
+        self.occupancy_frame = mem.frame_counter
+        return self.occupancy
+
+    def hasScriptMovement(self, idx, ctx):
+        if (mvmt := self.script_cache.get(idx)) is not None:
+            return mvmt
+        self.script_cache[idx] = self._checkScriptMovement(idx, ctx)
+        return self.script_cache[idx]
+
+    def _checkScriptMovement(self, idx, ctx):
+        for s in self.scripts.get(idx, []):
+            if ctx.getVar(s.var_nb, False) != s.var_val:
+                continue
+            sscript = Script.getScript(s.data_idx, self.map.bank_id, self.map.map_id)
+            # Scripts only depend on the state they read, share results between searches
+            key = (sscript.key, sscript.getInputValues(ctx))
+            if (moves := Pathfinder.script_movements.get(key)) is None:
+                moves = self._executeScriptMovement(sscript, ctx)
+                Pathfinder.script_movements[key] = moves
+            if moves:
+                return True
+        return False
+
+    def _executeScriptMovement(self, sscript, ctx):
+        # is duplicating the context necessary here?
+        out_ctxs = sscript.execute(Script.Context(ctx))
+        for out_ctx in out_ctxs:
+            for mvt_addr in out_ctx.outputs.filter(Script.Movement):
+                mvt_script = MvtScript(int(mvt_addr))
+                if mvt_script.dx != 0 or mvt_script.dy != 0:
+                    return True
+        return False
+
+    def _lock(self):
+        """ Lock dynamic objects from updates and clear cached obstacles """
+        self.clear()
         db.player.lock()
         database.OWObject.lock()
         for ow in db.ows:
             ow._checkUpdate()
-        self.dirty = True
+
+    def _unlock(self):
+        db.player.unlock()
+        database.OWObject.unlock()
+
+    def _getStart(self, xs, ys):
+        """ Index of the starting tile, None if invalid """
         # If start is inside a building, try to exit
         if (self.map.map_collision[ys,xs] == 1 and
             self.map.map_behavior[ys,xs] in db.warp_behaviors):
@@ -182,52 +175,228 @@ class Pathfinder:
             dx, dy = [(1, 0), (-1, 0), (0, -1), (0, 1)][key - io.Key.RIGHT]
             xs += dx
             ys += dy
-        start = self.getNode(xs, ys)
+        start = self.getIndex(xs, ys)
         if start is None:
             print("pathfinding error: invalid start (%d,%d)" % (xs, ys))
-            unlock()
+        return start
+
+    def search(self, xs, ys, dist_func, dist=0, ctx=None):
+        """
+        Returns the path from [xs,ys] to a given target
+        dist_func(x, y) returns the distance to the target from a tile
+        """
+        if ctx is None:
+            ctx = Script.Context()
+        self._lock()
+        if (start := self._getStart(xs, ys)) is None:
+            self._unlock()
             return None
-        start.setHeuristic(dist_func(start))
-        openset = [start]
-        closedset = []
+        ys, xs = divmod(start, self.map.width)
+        w = self.map.width
+        n = w * self.map.height
+        movement_cost = self.movement_cost.tolist()
+        occupied = self.getOccupancy().tolist()
+        weights = [0] * n
+        heuristics = [0] * n
+        dists = [9999] * n
+        prevs = [-1] * n
+        self.heuristics = heuristics
+        dists[start] = dist_func(xs, ys)
+        heuristics[start] = dists[start]
+        # Open set as a heap of (heuristic, insertion index, push index, tile)
+        # Outdated entries are skipped when popped instead of being removed.
+        # Tiles with equal heuristics are expanded in insertion order.
+        push_count = itertools.count()
+        open_seqs = {start: 0} # Insertion index of each tile in the open set
+        openset = [(heuristics[start], 0, next(push_count), start)]
+        closedset = set()
 
         while len(openset) > 0:
-            curr = openset.pop(self._getNextIndex(openset))
+            heuristic, seq, _, curr = heapq.heappop(openset)
+            if open_seqs.get(curr) != seq or heuristic != heuristics[curr]:
+                continue
+            del open_seqs[curr]
             # If the target is reached
-            if curr.dist == dist:
-                unlock()
-                return self._rebuildPath(curr)
+            if dists[curr] == dist:
+                self._unlock()
+                return self._rebuildPath(curr, prevs)
             # If the target is an NPC directly behind a counter
-            elif dist == 1 and curr.dist == 2:
+            elif dist == 1 and dists[curr] == 2:
+                cy, cx = divmod(curr, w)
                 for dir_i in range(4):
-                    dx = curr.x + np.sign(dir_i - 1) * (1 - dir_i % 2)
-                    dy = curr.y + np.sign(dir_i - 2) * (dir_i % 2)
+                    dx = cx + np.sign(dir_i - 1) * (1 - dir_i % 2)
+                    dy = cy + np.sign(dir_i - 2) * (dir_i % 2)
                     if (dx < 0 or dx >= self.map.width or
                         dy < 0 or dy >= self.map.height):
                         continue
                     if self.map.map_behavior[dy,dx] == 0x80:
-                        unlock()
-                        return self._rebuildPath(curr)
-            closedset.append(curr)
-            for next_node in curr.getNeighbors():
-                if next_node.hasOverWorld() or next_node.hasScriptMovement(ctx):
+                        self._unlock()
+                        return self._rebuildPath(curr, prevs)
+            closedset.add(curr)
+            for nxt in self.getNeighbors(curr):
+                if occupied[nxt] or self.hasScriptMovement(nxt, ctx):
                     continue
-                cost = curr.weight + next_node.movement_cost
-                visited = (next_node in closedset)
-                if visited and cost >= next_node.weight:
+                cost = weights[curr] + movement_cost[nxt]
+                visited = (nxt in closedset)
+                if visited and cost >= weights[nxt]:
                     continue
-                if not visited or cost < next_node.weight:
-                    next_node.prev = curr
-                    next_node.weight = cost
-                    next_node.setHeuristic(dist_func(next_node))
-                    if next_node not in openset:
-                        openset.append(next_node)
-        unlock()
+                if not visited or cost < weights[nxt]:
+                    prevs[nxt] = curr
+                    weights[nxt] = cost
+                    ny, nx = divmod(nxt, w)
+                    dists[nxt] = dist_func(nx, ny)
+                    heuristics[nxt] = cost + dists[nxt]
+                    if nxt not in open_seqs:
+                        open_seqs[nxt] = next(push_count)
+                    heapq.heappush(openset, (heuristics[nxt], open_seqs[nxt],
+                                             next(push_count), nxt))
+        self._unlock()
         return None
 
     def searchAny(self, xs, ys, locs, dist=0):
-        dist_func = lambda n: np.linalg.norm(locs - [n.x, n.y], ord=1, axis=1).min()
-        return self.search(xs, ys, dist_func, dist)
+        """ Returns the shortest path to any of 'locs', following its distance field """
+        self._lock()
+        if (start := self._getStart(xs, ys)) is None:
+            self._unlock()
+            return None
+        field, blocked = self._getDistanceField(locs, dist, Script.Context())
+        start_cost = self._getStartCost(start, locs, dist, field, blocked)
+        path = self._followField(start, field, blocked, start_cost)
+        self._unlock()
+        return path
+
+    def getCost(self, xs, ys, locs, dist=0, ctx=None):
+        """ Movement cost from [xs,ys] to any of 'locs', np.inf if unreachable """
+        if ctx is None:
+            ctx = Script.Context()
+        self._lock()
+        if (start := self._getStart(xs, ys)) is None:
+            self._unlock()
+            return np.inf
+        field, blocked = self._getDistanceField(locs, dist, ctx)
+        cost = self._getStartCost(start, locs, dist, field, blocked)
+        self._unlock()
+        return cost
+
+    def getDistanceField(self, locs, dist=0, ctx=None):
+        """
+        Returns the movement cost from each tile to reach any tile
+        at a manhattan distance 'dist' of 'locs', np.inf if unreachable
+        """
+        if ctx is None:
+            ctx = Script.Context()
+        self._lock()
+        field, blocked = self._getDistanceField(locs, dist, ctx)
+        self._unlock()
+        return field.reshape(self.map.height, self.map.width)
+
+    def _getDistanceField(self, locs, dist, ctx):
+        """
+        Cached version of the distance field
+        Fields are only recomputed when the dynamic obstacles they avoid change
+        """
+        locs = np.array(locs, dtype=int).reshape(-1, 2)
+        key = (locs.tobytes(), dist)
+        blocked = self._getBlocked(ctx)
+        if key in self.fields and self.fields[key][1] == blocked:
+            return self.fields[key]
+        if key not in self.fields and len(self.fields) >= Pathfinder.MAX_FIELDS:
+            del self.fields[next(iter(self.fields))]
+        self.fields[key] = (self._computeField(locs, dist, blocked), blocked)
+        return self.fields[key]
+
+    def _getBlocked(self, ctx):
+        """ Set of tiles blocked by overworlds or scripted movements """
+        blocked = set(np.flatnonzero(self.getOccupancy()).tolist())
+        for idx in self.scripts:
+            if self.hasScriptMovement(idx, ctx):
+                blocked.add(idx)
+        return frozenset(blocked)
+
+    def _getPredecessors(self):
+        """ Tiles from which each tile can be reached in one move """
+        if self.predecessors is None:
+            self.predecessors = [[] for i in range(len(self.adjacency))]
+            for idx in np.flatnonzero(self.adjacency).tolist():
+                for nxt in self.getNeighbors(idx):
+                    self.predecessors[nxt].append(idx)
+        return self.predecessors
+
+    def _getGoals(self, locs, dist):
+        """ Flat mask of the tiles at a manhattan distance 'dist' of 'locs' """
+        w, h = self.map.width, self.map.height
+        ys, xs = np.indices((h, w))
+        manhattan = np.abs(xs[..., None] - locs[:, 0]) + np.abs(ys[..., None] - locs[:, 1])
+        manhattan = manhattan.min(axis=2)
+        goals = (manhattan == dist)
+        # If the target is an NPC directly behind a counter
+        if dist == 1:
+            counter = np.pad(self.map.map_behavior == 0x80, 1)
+            near_counter = (counter[:-2, 1:-1] | counter[2:, 1:-1] |
+                            counter[1:-1, :-2] | counter[1:-1, 2:])
+            goals |= (manhattan == 2) & near_counter
+        return goals.ravel()
+
+    def _computeField(self, locs, dist, blocked):
+        """ Multi-source Dijkstra from the target tiles, on the reversed graph """
+        w, h = self.map.width, self.map.height
+        goals = self._getGoals(locs, dist)
+        predecessors = self._getPredecessors()
+        movement_cost = self.movement_cost.tolist()
+        field = [np.inf] * (w * h)
+        openset = [(0.0, idx) for idx in np.flatnonzero(goals).tolist() if idx not in blocked]
+        for _, idx in openset:
+            field[idx] = 0.0
+        while len(openset) > 0:
+            cost, curr = heapq.heappop(openset)
+            if cost > field[curr]:
+                continue
+            cost += movement_cost[curr]
+            for prev in predecessors[curr]:
+                if prev not in blocked and cost < field[prev]:
+                    field[prev] = cost
+                    heapq.heappush(openset, (cost, prev))
+        return np.array(field)
+
+    def _getStartCost(self, start, locs, dist, field, blocked):
+        """
+        Cost from the start tile, never considered blocked
+        An overworld can overlap the player's tile while moving, fields keep it blocked
+        so that they can be shared by every start
+        """
+        if start not in blocked:
+            return field[start]
+        if self._getGoals(np.array(locs, dtype=int).reshape(-1, 2), dist)[start]:
+            return 0.0
+        costs = [self.movement_cost[nxt] + field[nxt]
+                 for nxt in self.getNeighbors(start) if nxt not in blocked]
+        return min(costs, default=np.inf)
+
+    def _followField(self, start, field, blocked, start_cost):
+        """ Descend the distance field from 'start' to the closest target """
+        if start_cost == np.inf:
+            return None
+        movement_cost = self.movement_cost
+        curr = start
+        curr_cost = start_cost
+        path = [self.getCoords(curr)]
+        while curr_cost > 0:
+            best = None
+            for nxt in self.getNeighbors(curr):
+                if nxt in blocked:
+                    continue
+                cost = movement_cost[nxt] + field[nxt]
+                if best is None or cost < best_cost:
+                    best, best_cost = nxt, cost
+            curr = best
+            curr_cost = field[curr]
+            path.append(self.getCoords(curr))
+        return path
+
+    def getPlanner(self, locs, dist=0, ctx=None):
+        """ Incremental planner to any of 'locs', see Planner """
+        return Planner(self, locs, dist, ctx)
+
     def searchPos(self, xs, ys, xe, ye, dist=0):
         return self.searchAny(xs, ys, np.array([[xe, ye]]), dist)
     def searchPers(self, xs, ys, pers, dist=1):
@@ -239,42 +408,37 @@ class Pathfinder:
             return None
         return self.searchAny(xs, ys, conn.exits, dist)
 
-    def _getNextIndex(self, l):
-        minh = np.inf
-        mini = 0
-        for i, elm in enumerate(l):
-            if elm.heuristic < minh:
-                mini = i
-                minh = elm.heuristic
-        return mini
-
-    def _rebuildPath(self, node, l=None):
-        if l is None:
-            l = []
-        if node.prev:
-            self._rebuildPath(node.prev, l)
-        l.append([node.x, node.y])
-        return l
+    def _rebuildPath(self, idx, prevs):
+        path = []
+        while idx != -1:
+            path.append(self.getCoords(idx))
+            idx = prevs[idx]
+        return path[::-1]
 
     def clear(self):
-        """ Clear all node weights and paths """
-        for row in self.nodes:
-            for node in row:
-                if node:
-                    node.clear()
+        """ Clear dynamic data cached during a search """
+        self.script_cache = {}
 
-    def getNode(self, x, y):
+    def getIndex(self, x, y):
+        """ Flat index of a walkable tile, None otherwise """
         if not (0 <= x < self.map.width and 0 <= y < self.map.height):
             return None
-        return self.nodes[y][x]
+        idx = y * self.map.width + x
+        if not self.walkable[idx]:
+            return None
+        return idx
+
+    def getCoords(self, idx):
+        """ [x, y] coordinates of a flat tile index """
+        y, x = divmod(idx, self.map.width)
+        return [x, y]
 
     def plotPath(self, path):
         import matplotlib.pyplot as plt
         out = np.zeros(self.map.map_tile.shape)
-        for y in range(self.map.height):
-            for x in range(self.map.width):
-                if self.nodes[y][x]:
-                    out[y][x] = self.nodes[y][x].heuristic
+        if self.heuristics is not None:
+            out = np.array(self.heuristics, dtype=float).reshape(out.shape)
+            out[~self.walkable.reshape(out.shape)] = 0
         plt.imshow(out)
         if path is not None:
             plt.plot(*np.array(path).T, color="red")
@@ -282,25 +446,153 @@ class Pathfinder:
 
     def plot(self):
         import matplotlib.pyplot as plt
+        # Line offsets from the start and end tiles of each direction
+        offsets = {Pathfinder.UP: ((-.1, -.1), (-.1, .1)),
+                   Pathfinder.DOWN: ((.1, .1), (.1, -.1)),
+                   Pathfinder.LEFT: ((-.1, -.1), (.1, -.1)),
+                   Pathfinder.RIGHT: ((.1, .1), (-.1, .1))}
         xy = []
         ows = []
-        for row in self.nodes:
-            for node in row:
-                if node is None:
+        for idx in np.flatnonzero(self.walkable).tolist():
+            y, x = divmod(idx, self.map.width)
+            xy.append([x, y])
+            if self.hasOverWorld(idx):
+                ows.append([x, y])
+            mask = self.adjacency[idx]
+            for bit, step in self.steps:
+                if not mask & bit:
                     continue
-                xy.append([node.x, node.y])
-                if node.hasOverWorld():
-                    ows.append([node.x, node.y])
-                if node.right:
-                    plt.plot([node.x+.1, node.right.x-.1], [node.y+.1, node.right.y+.1])
-                if node.left:
-                    plt.plot([node.x-.1, node.left.x+.1], [node.y-.1, node.left.y-.1])
-                if node.up:
-                    plt.plot([node.x-.1, node.up.x-.1], [node.y-.1, node.up.y+.1])
-                if node.down:
-                    plt.plot([node.x+.1, node.down.x+.1], [node.y+.1, node.down.y-.1])
+                if mask & (bit << Pathfinder.JUMP_SHIFT):
+                    step <<= 1
+                ny, nx = divmod(idx + step, self.map.width)
+                (sx, sy), (ex, ey) = offsets[bit]
+                plt.plot([x+sx, nx+ex], [y+sy, ny+ey])
         plt.scatter(*np.array(xy).T, zorder=2.5)
-        plt.scatter(*np.array(ows).T, color="red", zorder=2.5)
+        if len(ows):
+            plt.scatter(*np.array(ows).T, color="red", zorder=2.5)
         plt.gca().invert_yaxis()
         plt.gca().set_aspect(1)
         plt.show()
+
+class Planner:
+    """
+    Incremental planner (D* Lite) to any tile at a manhattan distance 'dist' of 'locs'
+    Path costs are kept between searches, so when overworlds move
+    only the tiles around the ones that changed occupancy are repaired
+    """
+    def __init__(self, finder, locs, dist=0, ctx=None):
+        self.finder = finder
+        self.locs = np.array(locs, dtype=int).reshape(-1, 2)
+        self.dist = dist
+        self.ctx = Script.Context() if ctx is None else ctx
+        finder._lock()
+        field, self.blocked = finder._getDistanceField(self.locs, dist, self.ctx)
+        finder._unlock()
+        # The distance field is a fully consistent starting state
+        self.g = field.tolist()
+        self.rhs = list(self.g)
+        self.goals = set(np.flatnonzero(finder._getGoals(self.locs, dist)).tolist())
+        self.movement_cost = finder.movement_cost.tolist()
+        self.predecessors = finder._getPredecessors()
+        self.openset = []
+        self.open_keys = {} # Current key of each tile in the open set
+        self.km = 0
+        self.start = None
+
+    def search(self, xs, ys):
+        """ Returns the shortest path from [xs,ys], repairing costs if obstacles moved """
+        finder = self.finder
+        finder._lock()
+        if (start := finder._getStart(xs, ys)) is None:
+            finder._unlock()
+            return None
+        # The start is never blocked, an overworld can overlap it while moving
+        blocked = finder._getBlocked(self.ctx) - {start}
+        finder._unlock()
+        if self.start is not None:
+            self.km += self._heuristic(self.start, start)
+        self.start = start
+        if blocked != self.blocked:
+            changed = blocked ^ self.blocked
+            self.blocked = blocked
+            # Both the edges entering and leaving a changed tile are affected
+            for idx in changed:
+                self._updateTile(idx)
+                for prev in self.predecessors[idx]:
+                    self._updateTile(prev)
+        self._computeCosts()
+        return self._rebuildPath()
+
+    def _heuristic(self, a, b):
+        """ Lower bound of the cost between two tiles, a ledge jump moves 2 tiles for 1 """
+        ay, ax = divmod(a, self.finder.map.width)
+        by, bx = divmod(b, self.finder.map.width)
+        return (abs(ax - bx) + abs(ay - by)) / 2
+
+    def _getKey(self, idx):
+        cost = min(self.g[idx], self.rhs[idx])
+        return (cost + self._heuristic(self.start, idx) + self.km, cost)
+
+    def _updateTile(self, idx):
+        """ Recompute the lookahead cost of a tile and queue it if inconsistent """
+        if idx in self.blocked:
+            self.rhs[idx] = math.inf
+        elif idx in self.goals:
+            self.rhs[idx] = 0.0
+        else:
+            rhs = math.inf
+            for nxt in self.finder.getNeighbors(idx):
+                if nxt not in self.blocked:
+                    rhs = min(rhs, self.movement_cost[nxt] + self.g[nxt])
+            self.rhs[idx] = rhs
+        if self.g[idx] != self.rhs[idx]:
+            key = self._getKey(idx)
+            self.open_keys[idx] = key
+            heapq.heappush(self.openset, (key, idx))
+        else:
+            self.open_keys.pop(idx, None)
+
+    def _computeCosts(self):
+        openset = self.openset
+        while len(openset) > 0:
+            key, curr = openset[0]
+            # Outdated entries are skipped instead of being removed
+            if self.open_keys.get(curr) != key:
+                heapq.heappop(openset)
+                continue
+            if key >= self._getKey(self.start) and self.rhs[self.start] == self.g[self.start]:
+                break
+            heapq.heappop(openset)
+            new_key = self._getKey(curr)
+            if key < new_key:
+                self.open_keys[curr] = new_key
+                heapq.heappush(openset, (new_key, curr))
+                continue
+            del self.open_keys[curr]
+            if self.g[curr] > self.rhs[curr]:
+                self.g[curr] = self.rhs[curr]
+            else:
+                self.g[curr] = math.inf
+                self._updateTile(curr)
+            for prev in self.predecessors[curr]:
+                self._updateTile(prev)
+
+    def _rebuildPath(self):
+        """ Descend the path costs from the start to the closest target """
+        curr = self.start
+        if self.g[curr] == math.inf:
+            return None
+        path = [self.finder.getCoords(curr)]
+        while self.rhs[curr] > 0:
+            best, best_cost = None, math.inf
+            for nxt in self.finder.getNeighbors(curr):
+                if nxt in self.blocked:
+                    continue
+                cost = self.movement_cost[nxt] + self.g[nxt]
+                if cost < best_cost:
+                    best, best_cost = nxt, cost
+            if best is None or len(path) > len(self.g):
+                return None
+            curr = best
+            path.append(self.finder.getCoords(curr))
+        return path
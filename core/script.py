@@ -1,9 +1,11 @@
 import numpy as np
 import memory; mem = memory.Memory
 import database; db = database.Database
+from cache import Cache
 import struct
 import enum
 import sys
+import multiprocessing
 
 class MvtAction:
     def __init__(self, opcode, name, dx=0, dy=0):
@@ -639,6 +641,27 @@ class CommandResetVars(Command):
         Command.execute(self, open_ctxs, conditionals, ctx, instr)
 
 class Instruction:
+    # Decoded instructions, indexed by address
+    # The ROM is read-only, so entries are never invalidated
+    cache = {}
+    cache_hits = 0
+    cache_misses = 0
+
+    def get(addr):
+        """ Return the decoded instruction at 'addr', from the cache if possible """
+        if (instr := Instruction.cache.get(addr)) is not None:
+            Instruction.cache_hits += 1
+            return instr
+        Instruction.cache_misses += 1
+        instr = Instruction(addr)
+        Instruction.cache[addr] = instr
+        return instr
+
+    def clearCache():
+        Instruction.cache.clear()
+        Instruction.cache_hits = 0
+        Instruction.cache_misses = 0
+
     def __init__(self, addr):
         self.addr = addr
         self.opcode = mem.readU8(addr)
@@ -654,6 +677,15 @@ class Instruction:
     def __str__(self):
         return self.cmd.format(self)
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["cmd"] # Commands are shared, restored from the opcode
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.cmd = cmds[self.opcode]
+
 class Script:
     FLAG_COUNT = 0x900
     BANK_COUNT = 0x04
@@ -669,7 +701,12 @@ class Script:
     ITEM_ID = 0x800E
     LASTTALKED = 0x800F
 
+    CACHE_VERSION = 3
     cache = {}
+    readers = {} # Keys of the scripts reading each flag/variable
+    writers = {} # Keys of the scripts writing each flag/variable
+    next_index = {} # Keys of the scripts containing an instruction, indexed by its next address
+    loaded_maps = set()
 
     class Type(enum.IntEnum):
         PERSON = 0
@@ -682,11 +719,11 @@ class Script:
     class Storage:
         def __init__(self, fmt, val):
             self.fmt = fmt
-            self.val = val
+            self.val = int(val) # Values can come from numpy indices
         def __int__(self):
             return self.val
         def __eq__(self, other):
-            return self.val == other.val and type(self) == type(other)
+            return type(self) == type(other) and self.val == other.val
         def __str__(self):
             return self.fmt % self.val
         def __hash__(self):
@@ -711,26 +748,108 @@ class Script:
         def __init__(self, val):
             super().__init__("movement(0x%x)", val)
 
-    class StorageSet(set):
-        def getTrackable(self):
+    class StorageSet:
+        """
+        Set of Storage objects
+        Valid flags and variables are kept as int bitsets, other storages in a regular set
+        """
+        def __init__(self, items=()):
+            self.flags = 0 # Flags, then special flags
+            self.vars = 0 # Variables, then special variables
+            self.others = set()
+            for x in items:
+                self.add(x)
+
+        def flagBit(idx):
+            if Script.isFlag(idx):
+                return idx
+            if Script.isSpcFlag(idx):
+                return Script.FLAG_COUNT + idx - Script.SPCFLAG_OFFSET
+            return None
+        def varBit(idx):
+            if Script.isVar(idx):
+                return idx - Script.VAR_OFFSET
+            if Script.isSpcVar(idx):
+                return Script.VAR_COUNT + idx - Script.SPCVAR_OFFSET
+            return None
+
+        def addFlag(self, idx):
+            if (bit := Script.StorageSet.flagBit(idx)) is None:
+                self.others.add(Script.Flag(idx))
+            else:
+                self.flags |= 1 << bit
+        def addVar(self, idx):
+            if (bit := Script.StorageSet.varBit(idx)) is None:
+                self.others.add(Script.Var(idx))
+            else:
+                self.vars |= 1 << bit
+        def add(self, x):
+            if type(x) is Script.Flag:
+                self.addFlag(int(x))
+            elif type(x) is Script.Var:
+                self.addVar(int(x))
+            else:
+                self.others.add(x)
+
+        def __contains__(self, x):
+            if type(x) is Script.Flag and (bit := Script.StorageSet.flagBit(int(x))) is not None:
+                return bool(self.flags >> bit & 1)
+            if type(x) is Script.Var and (bit := Script.StorageSet.varBit(int(x))) is not None:
+                return bool(self.vars >> bit & 1)
+            return x in self.others
+
+        def _bits(mask):
+            while mask:
+                low = mask & -mask
+                yield low.bit_length() - 1
+                mask ^= low
+        def __iter__(self):
+            for bit in Script.StorageSet._bits(self.flags):
+                if bit >= Script.FLAG_COUNT:
+                    bit += Script.SPCFLAG_OFFSET - Script.FLAG_COUNT
+                yield Script.Flag(bit)
+            for bit in Script.StorageSet._bits(self.vars):
+                if bit >= Script.VAR_COUNT:
+                    yield Script.Var(bit - Script.VAR_COUNT + Script.SPCVAR_OFFSET)
+                else:
+                    yield Script.Var(bit + Script.VAR_OFFSET)
+            yield from self.others
+        def __len__(self):
+            return bin(self.flags).count("1") + bin(self.vars).count("1") + len(self.others)
+
+        def _combine(self, flags, vars, others):
             out = Script.StorageSet()
-            for var in self:
-                if type(var) is Script.Var:
-                    if (Script.isSpcVar(int(var)) or # Special vars
-                        int(var) < 0x4010): # Temp vars
-                        continue
-                    out.add(var)
-                elif type(var) is Script.Flag:
-                    if (Script.isSpcFlag(int(var)) or # Special flags
-                        int(var) < 0x20): # Temp flags
-                        continue
-                    out.add(var)
+            out.flags = flags
+            out.vars = vars
+            out.others = others
             return out
+        def __or__(self, other):
+            return self._combine(self.flags | other.flags, self.vars | other.vars,
+                                 self.others | other.others)
+        def __ior__(self, other):
+            self.flags |= other.flags
+            self.vars |= other.vars
+            self.others |= other.others
+            return self
+        def __and__(self, other):
+            return self._combine(self.flags & other.flags, self.vars & other.vars,
+                                 self.others & other.others)
+        def __eq__(self, other):
+            return (type(other) is Script.StorageSet and self.flags == other.flags and
+                    self.vars == other.vars and self.others == other.others)
+
+        def getTrackable(self):
+            # Skip special and temporary flags/vars
+            flags = self.flags & ((1 << Script.FLAG_COUNT) - (1 << 0x20))
+            vars = self.vars & ((1 << Script.VAR_COUNT) - (1 << 0x10))
+            others = {x for x in self.others if type(x) is Script.Flag}
+            return self._combine(flags, vars, others)
         def filter(self, cls):
-            sub = {x for x in self if type(x) is cls}
-            return Script.StorageSet(sub)
+            flags = self.flags if cls is Script.Flag else 0
+            vars = self.vars if cls is Script.Var else 0
+            return self._combine(flags, vars, {x for x in self.others if type(x) is cls})
         def copy(self):
-            return Script.StorageSet(super().copy())
+            return self._combine(self.flags, self.vars, self.others.copy())
         def __str__(self):
             return ",".join([str(x) for x in self])
 
@@ -746,6 +865,11 @@ class Script:
         return Script.SPCVAR_OFFSET <= x < Script.SPCVAR_OFFSET + Script.SPCVAR_COUNT
 
     class Context:
+        """
+        Script execution state
+        Flags and variables read from memory are never modified and shared between copies,
+        writes are stored in small per-context overlays
+        """
         def __init__(self, other=None):
             if other is None:
                 if (ptr := mem.readU32(0x03005008)) == 0:
@@ -754,9 +878,10 @@ class Script:
                 else:
                     self.flags = np.frombuffer(mem.readBuffer(ptr + 0xEE0, Script.FLAG_COUNT >> 3), dtype=np.uint8).copy()
                     self.variables = np.frombuffer(mem.readBuffer(ptr + 0x1000, Script.VAR_COUNT * 2), dtype=np.uint16).copy()
-                self.spcflags = np.zeros(Script.SPCFLAG_COUNT >> 3, dtype=np.uint8)
-                self.spcvars = np.zeros(Script.SPCVAR_COUNT, dtype=np.uint16)
-                self.banks = np.zeros(Script.BANK_COUNT, dtype=np.uint32)
+                # Written values, special flags/vars and banks start cleared
+                self.flag_writes = {}
+                self.var_writes = {}
+                self.bank_writes = {}
                 self.cmp1 = self.cmp2 = 0
                 self.pc = 0
                 self.stack = []
@@ -766,11 +891,11 @@ class Script:
                 self.choices = []
                 self.parent = None
             else:
-                self.flags = other.flags.copy()
-                self.spcflags = other.spcflags.copy()
-                self.variables = other.variables.copy()
-                self.spcvars = other.spcvars.copy()
-                self.banks = other.banks.copy()
+                self.flags = other.flags
+                self.variables = other.variables
+                self.flag_writes = other.flag_writes.copy()
+                self.var_writes = other.var_writes.copy()
+                self.bank_writes = other.bank_writes.copy()
                 self.cmp1 = other.cmp1
                 self.cmp2 = other.cmp2
                 self.pc = other.pc
@@ -802,24 +927,27 @@ class Script:
             if not (Script.isFlag(idx) or Script.isSpcFlag(idx)) and Script.isVar(idx):
                 idx = self.getVar(idx)
             if track:
-                self.inputs.add(Script.Flag(idx))
+                self.inputs.addFlag(idx)
+            if (val := self.flag_writes.get(idx)) is not None:
+                return val
             if Script.isFlag(idx):
                 return bool(self.flags[idx >> 3] & (1 << (idx & 7)))
             if Script.isSpcFlag(idx):
-                idx = idx - Script.SPCFLAG_OFFSET
-                return bool(self.spcflags[idx >> 3] & (1 << (idx & 7)))
+                return False
             print("Context error: flag %d(raw=%d) does not exist" % (idx, raw))
             return 0
 
         def getVar(self, idx, track=True):
             if Script.isVar(idx):
                 if track:
-                    self.inputs.add(Script.Var(idx))
+                    self.inputs.addVar(idx)
+                if (val := self.var_writes.get(idx)) is not None:
+                    return val
                 return self.variables[idx - Script.VAR_OFFSET]
             elif Script.isSpcVar(idx):
                 if track:
-                    self.inputs.add(Script.Var(idx))
-                return self.spcvars[idx - Script.SPCVAR_OFFSET]
+                    self.inputs.addVar(idx)
+                return self.var_writes.get(idx, np.uint16(0))
             else:
                 return idx
             return 0
@@ -828,7 +956,7 @@ class Script:
             if Script.isBank(idx):
                 if track:
                     self.inputs.add(Script.Bank(idx))
-                return self.banks[idx]
+                return self.bank_writes.get(idx, np.uint32(0))
             print("Context error: bank %d does not exist" % idx)
             return 0
 
@@ -837,26 +965,17 @@ class Script:
             if not (Script.isFlag(idx) or Script.isSpcFlag(idx)) and Script.isVar(idx):
                 idx = self.getVar(idx)
             if track:
-                self.outputs.add(Script.Flag(idx))
+                self.outputs.addFlag(idx)
             if Script.isFlag(idx) or Script.isSpcFlag(idx):
-                flagbuf = self.flags if Script.isFlag(idx) else self.spcflags
-                idx = idx if Script.isFlag(idx) else idx - Script.SPCFLAG_OFFSET
-                if val:
-                    flagbuf[idx >> 3] |= (1 << (idx % 8))
-                else:
-                    flagbuf[idx >> 3] &= ~(1 << (idx % 8))
+                self.flag_writes[idx] = bool(val)
             else:
                 print("Context error: flag %d(raw=%d) does not exist" % (idx, raw))
 
         def setVar(self, idx, val, track=True):
-            if Script.isVar(idx):
+            if Script.isVar(idx) or Script.isSpcVar(idx):
                 if track:
-                    self.outputs.add(Script.Var(idx))
-                self.variables[idx - Script.VAR_OFFSET] = val
-            elif Script.isSpcVar(idx):
-                if track:
-                    self.outputs.add(Script.Var(idx))
-                self.spcvars[idx - Script.SPCVAR_OFFSET] = val
+                    self.outputs.addVar(idx)
+                self.var_writes[idx] = np.uint16(int(val) & 0xFFFF)
             else:
                 print("Context error: variable %d does not exist" % idx)
 
@@ -864,7 +983,7 @@ class Script:
             if Script.isBank(idx):
                 if track:
                     self.outputs.add(Script.Bank(idx))
-                self.banks[idx] = val
+                self.bank_writes[idx] = np.uint32(int(val) & 0xFFFFFFFF)
             else:
                 print("Context error: bank %d does not exist" % idx)
 
@@ -891,33 +1010,121 @@ class Script:
         # Gather inputs and outputs from exploration
         self.inputs = Script.StorageSet()
         self.outputs = Script.StorageSet()
+        self.instrs = {} # Explored instructions, indexed by address
+        self.stacks = {} # Call stacks met at each explored instruction
         for ctx in self.explore():
             self.outputs |= ctx.outputs
             self.inputs |= ctx.inputs
-        # Store actual event
-        self.event = None
-        if bid >= 0 and mid >= 0 and stype < Script.Type.STD:
-            m = db.banks[bid][mid]
-            evts = [m.persons, m.signs, m.scripts, m.map_scripts][stype]
-            if idx >= 0 and idx < len(evts):
-                self.event = evts[idx]
+        # Explored instructions, indexed by the address following them
+        self.prevs = {}
+        for instr in self.instrs.values():
+            self.prevs.setdefault(instr.next_addr, []).append(instr)
         # NPC visibility flag is an input
         if self.type == Script.Type.PERSON and self.event.idx != 0:
             self.inputs.add(Script.Flag(self.event.idx))
 
+    @property
+    def event(self):
+        """ Actual map event, if any """
+        bid, mid, idx, stype = self.key
+        if bid < 0 or mid < 0 or stype >= Script.Type.STD:
+            return None
+        m = db.banks[bid][mid]
+        evts = [m.persons, m.signs, m.scripts, m.map_scripts][stype]
+        if idx >= 0 and idx < len(evts):
+            return evts[idx]
+        return None
+
+    def getInputValues(self, ctx):
+        """ Current values of the flags, variables and banks read by the script """
+        # Inputs in a fixed order, computed on first use
+        if (keys := getattr(self, "input_keys", None)) is None:
+            keys = []
+            for storage in self.inputs:
+                if type(storage) in (Script.Flag, Script.Var, Script.Bank):
+                    keys.append((type(storage).__name__, int(storage)))
+            self.input_keys = keys = sorted(keys)
+        out = []
+        for kind, idx in keys:
+            if kind == "Flag":
+                out.append(ctx.getFlag(idx, track=False))
+            elif kind == "Var":
+                out.append(int(ctx.getVar(idx, track=False)))
+            else:
+                out.append(int(ctx.getBank(idx, track=False)))
+        return tuple(out)
+
     def clearCache():
         Script.cache.clear()
-    def loadCache():
-        for bid, bank in enumerate(db.banks):
-            for mid, m in enumerate(bank):
-                for idx in range(len(m.persons)):
-                    Script.getPerson(idx, bid, mid)
-                for idx in range(len(m.signs)):
-                    Script.getSign(idx, bid, mid)
-                for idx in range(len(m.scripts)):
-                    Script.getScript(idx, bid, mid)
-                for idx in range(len(m.map_scripts)):
-                    Script.getMapScript(idx, bid, mid)
+        Script.readers.clear()
+        Script.writers.clear()
+        Script.next_index.clear()
+        Script.loaded_maps.clear()
+    def addToIndex(s):
+        """ Register the instructions and flags/variables read and written by a cached script """
+        for next_addr in s.prevs:
+            Script.next_index.setdefault(next_addr, set()).add(s.key)
+        for storage in s.inputs.filter(Script.Flag) | s.inputs.filter(Script.Var):
+            Script.readers.setdefault(storage, set()).add(s.key)
+        for storage in s.outputs.filter(Script.Flag) | s.outputs.filter(Script.Var):
+            Script.writers.setdefault(storage, set()).add(s.key)
+    def getReaders(storage):
+        """ Keys of the cached scripts with 'storage' in their inputs """
+        return Script.readers.get(storage, set())
+    def getWriters(storage):
+        """ Keys of the cached scripts with 'storage' in their outputs """
+        return Script.writers.get(storage, set())
+    def loadCache(processes=1, lazy=False):
+        """
+        Explore all scripts in the game
+        Results are stored on disk and loaded back if available
+        processes: number of worker processes exploring maps in parallel
+        lazy: without a cache on disk, explore maps only when they are first needed
+        """
+        if (cache := Cache.load("scripts", Script.CACHE_VERSION)) is not None:
+            Script.addScripts(cache)
+            return
+        if lazy:
+            return
+        maps = [(bid, mid) for bid, bank in enumerate(db.banks) for mid in range(len(bank))]
+        if processes > 1:
+            # Forked workers share the emulator memory pages until written, the ROM is only read
+            with multiprocessing.get_context("fork").Pool(processes) as pool:
+                for key, scripts in pool.imap_unordered(Script._exploreMap, maps, chunksize=4):
+                    Script.addScripts(scripts)
+                    Script.loaded_maps.add(key)
+        else:
+            for bid, mid in maps:
+                Script.loadMap(bid, mid)
+        Cache.save("scripts", Script.CACHE_VERSION, Script.cache)
+    def addScripts(scripts):
+        """ Merge explored scripts, indexed by key, into the cache """
+        Script.cache.update(scripts)
+        for s in scripts.values():
+            if s is not None:
+                # Share explored instructions with the interpreter
+                Instruction.cache.update(s.instrs)
+                Script.addToIndex(s)
+    def _exploreMap(key):
+        """ Worker side of loadCache, returns the scripts of a map """
+        # Only keep the current map's scripts to send back
+        Script.clearCache()
+        Script.loadMap(*key)
+        return key, dict(Script.cache)
+    def loadMap(bank_id, map_id):
+        """ Explore all scripts of a map """
+        if (bank_id, map_id) in Script.loaded_maps:
+            return
+        m = db.banks[bank_id][map_id]
+        for idx in range(len(m.persons)):
+            Script.getPerson(idx, bank_id, map_id)
+        for idx in range(len(m.signs)):
+            Script.getSign(idx, bank_id, map_id)
+        for idx in range(len(m.scripts)):
+            Script.getScript(idx, bank_id, map_id)
+        for idx in range(len(m.map_scripts)):
+            Script.getMapScript(idx, bank_id, map_id)
+        Script.loaded_maps.add((bank_id, map_id))
     def printCache(path="resources/scripts.txt"):
         with open(path, "w") as out:
             for (bid, mid, idx, stype), s in Script.cache.items():
@@ -938,6 +1145,7 @@ class Script:
                 s = None
             else:
                 s = Script(addr, bank_id, map_id, idx, stype)
+                Script.addToIndex(s)
             Script.cache[cache_idx] = s
             return s
 
@@ -984,26 +1192,20 @@ class Script:
         """
         bid = db.player.bank_id
         mid = db.player.map_id
-        m = db.banks[bid][mid]
-        # Search lask talked NPC first
+        Script.loadMap(bid, mid)
         local_id = db.getScriptVar(Script.LASTTALKED)
-        if ((local_id > 0 and local_id-1 < len(m.persons)) and
-            (s := Script.getPerson(local_id - 1, bid, mid)) and
-            (instr := s.searchPrevious(next_addr, stack))):
-            return s, instr
-
-        typelens = [(Script.Type.SCRIPT, len(m.scripts)),
-                    (Script.Type.MAPSCRIPT, len(m.map_scripts)),
-                    (Script.Type.PERSON, len(m.persons)),
-                    (Script.Type.SIGN, len(m.signs))]
-        for stype, count in typelens:
-            for i in range(count):
-                # Skip already searched LASTTALKED
-                if stype == Script.Type.PERSON and i == local_id-1:
-                    continue
-                if ((s := Script.getGeneric(i, stype, bid, mid)) and
-                    (instr := s.searchPrevious(next_addr, stack))):
-                    return s, instr
+        order = [Script.Type.SCRIPT, Script.Type.MAPSCRIPT, Script.Type.PERSON, Script.Type.SIGN]
+        def priority(key):
+            kbid, kmid, idx, stype = key
+            # Search last talked NPC first
+            return (stype != Script.Type.PERSON or idx != local_id-1, order.index(stype), idx)
+
+        keys = [key for key in Script.next_index.get(next_addr, ())
+                if key[0] == bid and key[1] == mid]
+        for key in sorted(keys, key=priority):
+            s = Script.cache[key]
+            if (instr := s.searchPrevious(next_addr, stack)):
+                return s, instr
         return None, None
 
     def print(self, out=sys.stdout):
@@ -1016,7 +1218,7 @@ class Script:
             return False
 
         def subPrint(addr):
-            instr = Instruction(addr)
+            instr = Instruction.get(addr)
             jumps = []
             while True:
                 # Exit on unknown opcodes
@@ -1033,7 +1235,7 @@ class Script:
                 # Exit at function end
                 if instr.opcode in [0x02, 0x03, 0x05]: # end/return/goto
                     break
-                instr = Instruction(instr.next_addr)
+                instr = Instruction.get(instr.next_addr)
             ranges.append((addr, instr.next_addr))
             for jump in jumps:
                 if not alreadyVisited(jump):
@@ -1048,22 +1250,13 @@ class Script:
             subPrint(addr)
 
     def searchPrevious(self, next_addr, stack=None):
-        context = Script.Context()
-        context.initFor(self)
-        conditionals = {}
-        open_ctxs = [context]
-        closed_ctxs = []
-        while len(open_ctxs) > 0:
-            ctx = open_ctxs.pop(0)
-            while True:
-                instr = Instruction(ctx.pc)
-                if (instr.next_addr == next_addr and
-                    (stack is None or tuple(stack) == tuple(ctx.stack))):
-                    return instr
-                instr.cmd.explore(open_ctxs, conditionals, ctx, instr)
-                if ctx.do_exit:
-                    closed_ctxs.append(ctx)
-                    break
+        """
+        Returns the explored instruction followed by 'next_addr' with the given call stack,
+        None if the script does not contain it
+        """
+        for instr in self.prevs.get(next_addr, []):
+            if stack is None or tuple(stack) in self.stacks[instr.addr]:
+                return instr
         return None
 
     def explore(self):
@@ -1075,7 +1268,9 @@ class Script:
         while len(open_ctxs) > 0:
             ctx = open_ctxs.pop(0)
             while True:
-                instr = Instruction(ctx.pc)
+                instr = Instruction.get(ctx.pc)
+                self.instrs[instr.addr] = instr
+                self.stacks.setdefault(instr.addr, set()).add(tuple(ctx.stack))
                 instr.cmd.explore(open_ctxs, conditionals, ctx, instr)
                 if ctx.do_exit:
                     closed_ctxs.append(ctx)
@@ -1092,7 +1287,7 @@ class Script:
         while len(open_ctxs) > 0:
             ctx = open_ctxs.pop(0)
             while True:
-                instr = Instruction(ctx.pc)
+                instr = Instruction.get(ctx.pc)
                 instr.cmd.execute(open_ctxs, conditionals, ctx, instr)
                 if ctx.do_exit:
                     closed_ctxs.append(ctx)
@@ -0,0 +1,83 @@
+import collections
+import numpy as np
+import memory; mem = memory.Memory
+import database; db = database.Database
+import core.io; io = core.io.IO
+from script import Script
+from metafinder import Metafinder
+
+class Snapshot(object):
+    """
+    In-memory snapshots of the emulator, kept in a ring buffer.
+    Python objects deriving state from the game can be registered to be saved
+    and restored along with it, through their getState/setState methods.
+    """
+    ring = collections.deque(maxlen=16)
+    providers = []
+
+    def init(core, capacity=16):
+        Snapshot.core = core
+        Snapshot.ring = collections.deque(maxlen=capacity)
+
+    def register(obj):
+        """ Save and restore the state of 'obj' with each snapshot """
+        if obj not in Snapshot.providers:
+            Snapshot.providers.append(obj)
+    def unregister(obj):
+        if obj in Snapshot.providers:
+            Snapshot.providers.remove(obj)
+
+    def take():
+        """ Capture the current state and push it in the ring buffer """
+        snap = {"state": Snapshot.core.save_raw_state(),
+                "keys": io.getRaw(),
+                "flags": db.getScriptFlags(),
+                "vars": db.getScriptVars(),
+                "providers": [(obj, obj.getState()) for obj in Snapshot.providers]}
+        Snapshot.ring.append(snap)
+        return snap
+
+    def restore(snap=None):
+        """
+        Restore a snapshot, the most recent one if not specified
+        Returns 0 on success, -1 otherwise
+        """
+        if snap is None:
+            if len(Snapshot.ring) == 0:
+                print("snapshot error: no snapshot to restore")
+                return -1
+            snap = Snapshot.ring[-1]
+        flags_old = db.getScriptFlags()
+        vars_old = db.getScriptVars()
+        if not Snapshot.load(snap["state"]):
+            print("snapshot error: cannot load emulator state")
+            return -1
+        io.setRaw(snap["keys"])
+        # Objects unregistered since the snapshot are left alone
+        for obj, state in snap["providers"]:
+            if obj in Snapshot.providers:
+                obj.setState(state)
+        # Forget cached routes depending on flags/vars that went back in time
+        changed = [Script.Flag(int(x)) for x in np.where(snap["flags"] != flags_old)[0]]
+        changed += [Script.Var(0x4000+int(x)) for x in np.where(snap["vars"] != vars_old)[0]]
+        Metafinder.invalidate(changed)
+        return 0
+
+    def load(state):
+        """ Load a raw emulator state only, returns False on failure """
+        frame = mem.frame_counter
+        if not Snapshot.core.load_raw_state(state):
+            return False
+        # Keep the frame counter increasing so that every AutoUpdater reloads its data
+        mem.frame_offset = frame + 1 - Snapshot.core.frame_counter
+        mem.updateBuffers()
+        return True
+
+    def pop():
+        """ Remove and return the most recent snapshot, None if empty """
+        if len(Snapshot.ring) == 0:
+            return None
+        return Snapshot.ring.pop()
+
+    def clear():
+        Snapshot.ring.clear()
@@ -68,6 +68,9 @@ class Map():
         if connect_ptr != 0:
             nb_connects, connect_ptr = mem.unpack(connect_ptr, "2I")
             self.connects = utils.rawArray(Connection, connect_ptr, nb_connects)
+        for connect in self.connects:
+            connect.bank_id = bank_id
+            connect.map_id = map_id
 
         # Name
         name_addr = mem.readU32(0x083F1CAC + (self.map_hdr.label_id - 88) * 4)
@@ -85,31 +88,33 @@ class Map():
         data_ptr = data_hdr.data_ptr & 0xFFFFFF
         sz = self.width * self.height
         data = np.frombuffer(rom[data_ptr:data_ptr+(2 * sz)], dtype=np.uint16)
-        data = data.reshape(self.height, self.width)
+        self.loadTiles(data.reshape(self.height, self.width))
+
+        # Physically reachable warps
+        self.phys_warps = []
+        for warp in self.warps:
+            if self.map_behavior[warp.y, warp.x] != 0:
+                self.phys_warps.append(warp)
+
+        # Wild battles
+        self.wild_battles = []
+        for i in range(4):
+            self.wild_battles.append(WildBattle())
+
+    def loadTiles(self, data, attrs=None, blocks=None):
+        """
+        Build tile arrays from raw map data.
+        attrs and blocks are resolved from the tilesets when not provided.
+        """
+        self.map_data = data
         self.map_status = (data >> 10).astype(np.uint8)
         self.map_collision = self.map_status & 3
         self.map_level = self.map_status >> 2
         self.map_tile = (data & 1023)
-        self.map_attrs = np.zeros(data.shape, dtype=np.uint32)
-        self.map_blocks = np.zeros(data.shape, dtype=np.uint16)
-        tile_dict = {} # Cache tile attribute when possible
-        # Fill background and behavior from tilesets
-        for y, line in enumerate(self.map_tile):
-            for x, t in enumerate(line):
-                if t not in tile_dict:
-                    if t < 640:
-                        tileset = data_hdr.global_tileset
-                        tileset_idx = t
-                    else:
-                        tileset = data_hdr.local_tileset
-                        tileset_idx = t - 640
-
-                    block = mem.readU16(tileset.blocks_ptr + tileset_idx * 2)
-                    attr = mem.readU32(tileset.behavior_ptr + tileset_idx * 4)
-                    tile_dict[t] = (block, attr)
-                block, attr = tile_dict[t]
-                self.map_attrs[y, x] = attr
-                self.map_blocks[y, x] = block
+        if attrs is None or blocks is None:
+            attrs, blocks = self._resolveTiles()
+        self.map_attrs = attrs
+        self.map_blocks = blocks
         self.map_behavior  = (self.map_attrs & 0x000001ff) >> 0
         self.map_terrain   = (self.map_attrs & 0x00003e00) >> 9
         self.map_attr2     = (self.map_attrs & 0x0003c000) >> 14
@@ -120,16 +125,25 @@ class Map():
         self.map_attr7     = (self.map_attrs & 0x80000000) >> 31
         self.pathfinder = None
 
-        # Physically reachable warps
-        self.phys_warps = []
-        for warp in self.warps:
-            if self.map_behavior[warp.y, warp.x] != 0:
-                self.phys_warps.append(warp)
-
-        # Wild battles
-        self.wild_battles = []
-        for i in range(4):
-            self.wild_battles.append(WildBattle())
+    def _resolveTiles(self):
+        """ Fill background and behavior from tilesets """
+        data_hdr = self.map_hdr.data_hdr
+        global_attrs, global_blocks = data_hdr.global_tileset.getTables(640)
+        local_attrs, local_blocks = data_hdr.local_tileset.getTables(1024 - 640)
+        attrs = np.concatenate([global_attrs, local_attrs])[self.map_tile]
+        blocks = np.concatenate([global_blocks, local_blocks])[self.map_tile]
+        return attrs, blocks
+
+    # Tile arrays are stored separately by the database cache
+    tile_arrays = ["map_data", "map_status", "map_collision", "map_level", "map_tile",
+                   "map_attrs", "map_blocks", "map_behavior", "map_terrain", "map_attr2",
+                   "map_attr3", "map_encounter", "map_attr5", "map_layer", "map_attr7"]
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in Map.tile_arrays:
+            state.pop(name, None)
+        state["pathfinder"] = None
+        return state
 
     def isOutside(self):
         return self.map_hdr.type in [MapType.TOWN, MapType.CITY, MapType.ROUTE,
@@ -221,6 +235,7 @@ class DataHeader(utils.RawStruct):
 
 class TilesetHeader(utils.RawStruct):
     fmt = "2B2x5I"
+    tables = {} # Tile tables, indexed by tileset address
     def __init__(self, addr):
         (self.compressed,
          self.secondary,
@@ -230,6 +245,18 @@ class TilesetHeader(utils.RawStruct):
          self.anim_ptr,
          self.behavior_ptr) = super().__init__(addr)
 
+    def getTables(self, count):
+        """
+        Return the behavior and block tables of the first 'count' tiles
+        Tables are read once per tileset and shared by all maps using it
+        """
+        key = (self.addr, count)
+        if key not in TilesetHeader.tables:
+            attrs = np.frombuffer(mem.readBuffer(self.behavior_ptr, count * 4), dtype=np.uint32)
+            blocks = np.frombuffer(mem.readBuffer(self.blocks_ptr, count * 2), dtype=np.uint16)
+            TilesetHeader.tables[key] = (attrs, blocks)
+        return TilesetHeader.tables[key]
+
 class Event(utils.RawStruct):
     fmt = "4B4I"
     def __init__(self, addr):
@@ -362,6 +389,17 @@ class Connection(utils.RawStruct):
          self.offset,
          self.dest_bank,
          self.dest_map) = super().__init__(addr)
+        # Source map, set by the map owning the connection
+        self.bank_id = -1
+        self.map_id = -1
+        self._exits = None
+
+    @property
+    def exits(self):
+        """ Exit tiles, computed on first access """
+        if self._exits is None:
+            self.findExits(db.banks[self.bank_id][self.map_id])
+        return self._exits
 
     def get(info, m=None):
         def _findConnection(m, ctype):
@@ -414,6 +452,7 @@ class Connection(utils.RawStruct):
     def findExits(self, m):
         exits = []
         if self.type == ConnectType.NONE or self.type > ConnectType.RIGHT:
+            self._exits = np.zeros((0, 2), dtype=int)
             return
         dmap = db.banks[self.dest_bank][self.dest_map]
         x = (self.type == ConnectType.RIGHT) * (m.width - 1)
@@ -438,7 +477,7 @@ class Connection(utils.RawStruct):
 
             x += xstep
             y += ystep
-        self.exits = np.array(exits)
+        self._exits = np.array(exits)
 
 class WildBattle():
     def __init__(self):
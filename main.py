@@ -8,7 +8,6 @@ import numpy as np
 import mgba.core
 import mgba.image
 import mgba.log
-import pygame
 
 sys.path += ["core", "bot"]
 import world
@@ -26,11 +25,42 @@ import battle
 import path
 import ui
 from script import Script
+from cache import Cache
+from snapshot import Snapshot
 from bot import Bot
+from lookahead import Lookahead
+
+def positiveInt(value):
+    if int(value) < 1:
+        raise argparse.ArgumentTypeError("%s is not a positive integer" % value)
+    return int(value)
+
+def nonNegativeInt(value):
+    if int(value) < 0:
+        raise argparse.ArgumentTypeError("%s is a negative integer" % value)
+    return int(value)
 
 parser = argparse.ArgumentParser(description="Pokebot")
 parser.add_argument("-r", "--rom", type=str, default=os.path.expanduser("~/Games/Pokemon - FireRed Version (USA).gba"),
                     help="Path to the Pokemon Firered v1.0 ROM")
+parser.add_argument("--cache-dir", type=str, default=os.path.expanduser("~/.cache/pypokebot"),
+                    help="Directory storing data extracted from the ROM")
+parser.add_argument("--no-cache", action="store_true",
+                    help="Always extract data from the ROM, without reading or writing the cache")
+parser.add_argument("--lazy", action="store_true",
+                    help="Only build maps and explore scripts missing from the cache when they are first needed")
+parser.add_argument("--warmup", action="store_true",
+                    help="With --lazy, load remaining maps in the background and save them to the cache")
+parser.add_argument("-j", "--jobs", type=positiveInt, default=1,
+                    help="Number of processes exploring scripts when they are not cached, or simulating battles with --lookahead")
+parser.add_argument("--headless", action="store_true",
+                    help="Run as fast as possible without opening a window")
+parser.add_argument("--frames", type=int, default=-1,
+                    help="With --headless, stop after this number of frames")
+parser.add_argument("--frame-skip", type=positiveInt, default=1,
+                    help="In turbo mode, only display one frame out of this number")
+parser.add_argument("--lookahead", type=nonNegativeInt, default=0,
+                    help="Choose battle moves by simulating this number of turns (0 to disable)")
 
 args = parser.parse_args()
 mgba.log.silence()
@@ -39,16 +69,32 @@ core.autoload_save()
 size = core.desired_video_dimensions()
 screen_buf = mgba.image.Image(*size)
 core.set_video_buffer(screen_buf)
+# RGBX pixels of the video buffer, written in place by mgba
+frame = np.frombuffer(mgba.ffi.buffer(screen_buf.buffer), dtype=np.uint8).reshape(size[1], size[0], 4)
 core.reset()
 mem.init(core)
 io.init(core)
-db.init()
-Script.loadCache()
-screen = pygame.display.set_mode(size)
-clock = pygame.time.Clock()
+Snapshot.init(core)
+if not args.no_cache:
+    Cache.init(args.cache_dir)
+maps_pending = db.init(args.lazy)
+Script.loadCache(args.jobs, args.lazy)
+# Simulation workers are forked before the warm-up thread starts
+if args.lookahead > 0:
+    Lookahead.init(args.jobs)
+if maps_pending and args.warmup:
+    db.warmUp()
+if not args.headless:
+    # Headless runs do not need pygame to be installed
+    import pygame
+    io.initKeymap()
+    screen = pygame.display.set_mode(size)
+    clock = pygame.time.Clock()
 
 def runGame(bot=None):
     onPreFrame = None if bot is None else bot.onPreFrame()
+    # The surface wraps the video buffer, blitting it always shows the last frame
+    surface = pygame.image.frombuffer(frame, size, "RGBX")
 
     while True:
         clock.tick(0 if io.turbo else 60)
@@ -77,14 +123,31 @@ def runGame(bot=None):
         core.run_frame()
         mem.updateBuffers()
 
-        surface = pygame.image.frombuffer(screen_buf.to_pil().tobytes(), size, "RGBX")
-        screen.blit(surface, (0, 0))
-        pygame.display.flip()
+        if not io.turbo or mem.frame_counter % args.frame_skip == 0:
+            screen.blit(surface, (0, 0))
+            pygame.display.flip()
+
+def runHeadless(bot=None, max_frames=-1):
+    """
+    Run the game without display, input events nor frame limit
+    max_frames: number of frames to run, -1 to run until the bot stops
+    """
+    onPreFrame = None if bot is None else bot.onPreFrame()
+    end_frame = mem.frame_counter + max_frames
+    while max_frames < 0 or mem.frame_counter < end_frame:
+        if onPreFrame is not None and next(onPreFrame, -1) == -1:
+            return
+        core.run_frame()
+        mem.updateBuffers()
+
+def saveFrame(path):
+    """ Save the last emulated frame as an image, the display is never needed """
+    screen_buf.to_pil().save(path)
 
 def mainAI(bot):
     io.releaseAll()
     io.turbo = True
-    while core.frame_counter < 800:
+    while mem.frame_counter < 800:
         yield io.toggle(core.KEY_A)
     io.turbo = False
     yield from movement.toConnection(world.ConnectType.DOWN)
@@ -122,7 +185,10 @@ def battleAI(bot):
             # If the pokemon has not been caught yet, try to catch it
             if (not db.pokedex.hasOwned(enemy.growth.species_idx) and
                 db.battle_context.isCatchable()):
-                move = Bot.getWeakenMove()
+                if args.lookahead > 0:
+                    move = Lookahead.getWeakenMove(args.lookahead)
+                else:
+                    move = Bot.getWeakenMove()
                 pokeball = db.items.poke_ball
                 if db.bag.hasItem(pokeball):
                     if move is None:
@@ -130,7 +196,10 @@ def battleAI(bot):
                     else:
                         yield from battle.attack(move)
                     continue
-            move = Bot.getBestMove()
+            if args.lookahead > 0:
+                move = Lookahead.getBestMove(args.lookahead)
+            else:
+                move = Bot.getBestMove()
             yield from battle.attack(move)
         else:
             # If a pokemon was caught, skip nickname
@@ -140,6 +209,10 @@ def battleAI(bot):
                 continue
             yield io.toggle(core.KEY_A)
 
-runGame(Bot(mainAI, battleAI))
-pygame.display.quit()
+if args.headless:
+    runHeadless(Bot(mainAI, battleAI), args.frames)
+else:
+    runGame(Bot(mainAI, battleAI))
+    pygame.display.quit()
+Lookahead.close()
 m = db.getCurrentMap()
@@ -0,0 +1,36 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+pytest.importorskip("mgba")
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path += [root, os.path.join(root, "core"), os.path.join(root, "bot")]
+# Same import order as main.py, some modules import each other
+import world
+import interact
+from script import Script
+from bot import Bot
+
+def _getChanged():
+    """ Changed flags and variables, built from array diffs with numpy indices """
+    flags_changed = np.where(np.arange(0x900) % 0x100 == 0x40)[0]
+    vars_changed = np.where(np.arange(0x100) == 0x20)[0]
+    changed = [Script.Flag(x) for x in flags_changed]
+    changed += [Script.Var(0x4000+x) for x in vars_changed]
+    return changed
+
+def test_storage_from_numpy_index():
+    flag = Script.Flag(np.int64(0x40))
+    assert type(int(flag)) is int
+    assert flag == Script.Flag(0x40)
+    assert flag in Script.StorageSet([Script.Flag(0x40)])
+
+def test_check_hooks_numpy_indices():
+    bot = Bot.__new__(Bot)
+    bot.npc_waitlist = set()
+    bot.npc_visited = set()
+    changed = _getChanged()
+    bot.checkHooks(changed)
+    trackable = set(Script.StorageSet(changed).getTrackable())
+    assert trackable == set(changed)